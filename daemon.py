@@ -0,0 +1,203 @@
+import json
+import os
+import signal
+import socket
+import SocketServer
+import StringIO
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+import evaluator
+import preprocess
+import raytracer
+
+# Renders GML scenes sent over a Unix socket, so that a stream of small
+# scenes doesn't start Python, import the modules, preprocess the
+# includes and evaluate the libraries for every one of them. The daemon
+# makes its preludes, then forks a pool of worker processes, which
+# inherit them and keep their own preprocessor caches between jobs.
+# Every worker renders one scene at a time, in the directory of the
+# client that sent it, with raytracer.workers at 1.
+#
+# A client sends a job per line, {"file": path, "cwd": directory}, and
+# closes its side of the connection. The daemon answers a line per
+# job, in the same order, with "file", "output" (what the evaluator
+# printed), "error" (a Python traceback, if the job raised one),
+# "prelude" (whether a prelude was used) and "times" in seconds:
+# "queued" before a worker took the job, "parse", "evaluate" (without
+# rendering), "render" and "total".
+
+# in the worker processes: (check types, memo size, preludes)
+options = None
+
+def init_worker(check_types, memo_size, preludes):
+    global options
+    options = (check_types, memo_size, preludes)
+    raytracer.workers = 1
+
+def run_job(job):
+    check_types, memo_size, preludes = options
+    start = time.time()
+    times = {'queued': start - job['received'], 'render': 0.0}
+    result = {'file': job['file'], 'times': times, 'error': None,
+              'prelude': False}
+    output = StringIO.StringIO()
+    stdout = sys.stdout
+    render = raytracer.render
+    def timed_render(*args):
+        t = time.time()
+        try:
+            render(*args)
+        finally:
+            times['render'] += time.time() - t
+    sys.stdout = output
+    raytracer.render = timed_render
+    evaluator.memo_size = memo_size
+    try:
+        try:
+            os.chdir(job['cwd'])
+            prelude = evaluator.run_file(job['file'], check_types, preludes, times)
+            result['prelude'] = prelude is not None
+        except Exception:
+            result['error'] = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+        raytracer.render = render
+        evaluator.memo_caches.clear()
+    if 'evaluate' in times:
+        times['evaluate'] -= times['render']
+    times['total'] = time.time() - start
+    result['output'] = output.getvalue()
+    return result
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        pending = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                job = {'file': str(job['file']), 'cwd': str(job['cwd']),
+                       'received': time.time()}
+            except (ValueError, KeyError, TypeError):
+                pending.append({'error': "bad job: %r" % line})
+                continue
+            pending.append(self.server.pool.apply_async(run_job, (job,)))
+        for r in pending:
+            if isinstance(r, dict):
+                result = r
+            else:
+                try:
+                    result = r.get()
+                except Exception:
+                    result = {'error': traceback.format_exc()}
+            self.wfile.write(json.dumps(result) + "\n")
+            self.wfile.flush()
+
+class Server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def stop(signum, frame):
+    # the SIGTERMs after the first can't interrupt the shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+def serve(path, nworkers, check_types, memo_size, prelude_files):
+    if os.path.exists(path):
+        # a socket nobody listens on is left from a daemon that died
+        s = socket.socket(socket.AF_UNIX)
+        try:
+            s.connect(path)
+        except socket.error:
+            os.remove(path)
+        else:
+            s.close()
+            print "a daemon is already listening on", path
+            sys.exit(1)
+    evaluator.memo_size = memo_size
+    preludes = [evaluator.Prelude(files) for files in prelude_files]
+    pool = Pool(nworkers, init_worker, (check_types, memo_size, preludes))
+    # after the workers are forked, so that only the daemon exits on
+    # SIGTERM, removing its socket
+    signal.signal(signal.SIGTERM, stop)
+    server = Server(path, Handler)
+    server.pool = pool
+    print "listening on %s with %d workers" % (path, nworkers)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        # the socket first, so that nothing can interrupt its removal
+        server.server_close()
+        os.remove(path)
+        pool.terminate()
+        pool.join()
+
+def submit(path, files):
+    # sends the scenes in files to the daemon listening on path, and
+    # prints what they printed and their times as they are done
+    s = socket.socket(socket.AF_UNIX)
+    s.connect(path)
+    cwd = os.getcwd()
+    for f in files:
+        s.sendall(json.dumps({'file': os.path.abspath(f), 'cwd': cwd}) + "\n")
+    s.shutdown(socket.SHUT_WR)
+    for f, line in zip(files, s.makefile()):
+        result = json.loads(line)
+        print f
+        print "=" * len(f)
+        sys.stdout.write(result.get('output', ''))
+        if result['error']:
+            sys.stdout.write(result['error'])
+        times = result.get('times')
+        if times:
+            print "time: %s" % " ".join(
+                ["%s %.3f" % (k, times[k]) for k in
+                 ['queued', 'parse', 'evaluate', 'render', 'total'] if k in times]),
+            if result['prelude']:
+                print "(prelude)"
+            else:
+                print
+        print
+        sys.stdout.flush()
+    s.close()
+
+if __name__=="__main__":
+    # daemon.py [-j workers] [-t] [--memo size] [--cache directory]
+    #           [--prelude files]... socket
+    # daemon.py --submit socket files...
+    args = sys.argv[1:]
+    if args[:1] == ["--submit"]:
+        submit(args[1], args[2:])
+        sys.exit(0)
+
+    nworkers = 1
+    if "-j" in args:
+        i = args.index("-j")
+        nworkers = int(args[i + 1])
+        del args[i:i + 2]
+
+    check_types = "-t" in args
+    if check_types:
+        args.remove("-t")
+
+    memo_size = 0
+    if "--memo" in args:
+        i = args.index("--memo")
+        memo_size = int(args[i + 1])
+        del args[i:i + 2]
+
+    if "--cache" in args:
+        i = args.index("--cache")
+        preprocess.disk_cache = os.path.abspath(args[i + 1])
+        del args[i:i + 2]
+
+    prelude_files = []
+    while "--prelude" in args:
+        i = args.index("--prelude")
+        prelude_files.append(args[i + 1].split(","))
+        del args[i:i + 2]
+
+    serve(args[0], nworkers, check_types, memo_size, prelude_files)
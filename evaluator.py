@@ -1,8 +1,21 @@
+import hashlib
+import itertools
 import math
+import os
+import time
+import gmlmath
+from gmlmath import divi, modi
 import primitives
 import lights
 import raytracer
-import copy
+import surfacecompiler
+import typechecker
+import partialeval
+import gmlprofile
+import memo
+import tokenizer
+import parser
+import preprocess
 
 class GMLRuntimeError(Exception):
     pass
@@ -13,482 +26,886 @@ class GMLTypeError(Exception):
 class GMLSubscriptError(Exception):
     pass
 
-def get_type(t):
-    return t[0]
+surfacecompiler.subscript_error = GMLSubscriptError
 
-def get_value(t):
-    return t[1]
+# Runtime values are native Python values: Integers are ints, Reals
+# floats, Booleans bools and Strings strs, Points are tuples of three
+# floats, Arrays lists, and objects and lights the renderer's own. The
+# operators check the types of their operands with type(x) is, since
+# Python would mix ints and floats, and apply, if and the primitives
+# check that they get closures and booleans.
+class Closure(object):
+    __slots__ = ['env', 'code']
 
-def check_type(obj, typename):
-    return typename == get_type(obj)
+    def __init__(self, env, code):
+        self.env = env
+        self.code = code
 
-check_integer = lambda t: check_type(t, 'Integer')
-check_real = lambda t: check_type(t, 'Real')
-check_boolean = lambda t: check_type(t, 'Boolean')
-check_closure = lambda t: check_type(t, 'Closure')
-check_identifier = lambda t: check_type(t, 'Identifier')
-check_point = lambda t: check_type(t, 'Point')
-check_array = lambda t: check_type(t, 'Array')
-check_string = lambda t: check_type(t, 'String')
+def check_closure(c):
+    if c.__class__ is not Closure:
+        raise GMLTypeError
+    return c
 
-def divi(a, b):
-    rv = a // b
-    if rv < 0:
-        rv += 1 # we need to round towards zero, which python doesn't
-    return rv
+def check_boolean(b):
+    if b is not True and b is not False:
+        raise GMLTypeError
+    return b
 
-def modi(a, b):
-    return a - b * divi(a, b)
+def get_node(obj):
+    if not isinstance(obj, primitives.Node):
+        raise GMLTypeError
+    return obj
 
-def make_integer(v):
-    assert type(v) == int
-    return ('Integer', v)
+light_types = (lights.Light, lights.PointLight, lights.SpotLight)
 
-def get_integer(i):
-    assert check_integer(i)
-    return get_value(i)
+# The operand stack is a list, with its top at the end, which the
+# operators change in place
+def make_stack():
+    return []
 
-def make_string(v):
-    assert type(v) == str
-    return ('String', v)
+# An environment is a chain of frames, (slots, parent), with one frame
+# for every running closure body. The names are resolved to a depth in
+# the chain and a slot in the frame when the code is compiled. Every
+# binder has a slot of its own, which is written once per call, so
+# closures can share the frames they capture.
+def make_env():
+    return None
+
+def get_env(env, depth, slot):
+    for i in range(depth):
+        env = env[1]
+    return env[0][slot]
+
+class Scope(object):
+    # the names bound at a point of the code, with the slots of the
+    # current frame, and the scope the closure was made in
+    def __init__(self, names, parent):
+        self.names = names
+        self.parent = parent
+
+    def bind(self, name, slot):
+        names = dict(self.names)
+        names[name] = slot
+        return Scope(names, self.parent)
+
+    def resolve(self, name):
+        depth = 0
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return depth, scope.names[name]
+            scope = scope.parent
+            depth += 1
+        return None
+
+class Environment(object):
+    # the values of the names of a scope, looked up by name, for the
+    # surface compiler and the top level
+    def __init__(self, scope, env):
+        self.scope = scope
+        self.env = env
+
+    def __contains__(self, name):
+        return self.scope is not None and self.scope.resolve(name) is not None
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        depth, slot = self.scope.resolve(name)
+        return get_env(self.env, depth, slot)
+
+def eval_addi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(i1 + i2)
 
-def get_string(s):
-    assert check_string(s)
-    return get_value(s)
+def eval_addf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
+        raise GMLTypeError
+    stack.append(r1 + r2)
 
-def make_real(v):
-    assert type(v) == float
-    return ('Real', v)
+def eval_acos(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.acos(r))
 
-def get_real(r):
-    assert check_real(r)
-    return get_value(r)
+def eval_asin(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.asin(r))
 
-def make_boolean(v):
-    assert type(v) == bool
-    return ('Boolean', v)
+def eval_clampf(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.clampf(r))
 
-def get_boolean(b):
-    assert check_boolean(b)
-    return get_value(b)
+def eval_cos(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.cos(r))
 
-def make_closure(env, v):
-    return ('Closure', (env, v[:]))
+def eval_divi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(divi(i1, i2))
 
-def get_closure_env(c):
-    assert check_closure(c)
-    closure = get_value(c)
-    return closure[0]
+def eval_divf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
+        raise GMLTypeError
+    stack.append(r1 / r2)
 
-def get_closure_function(c):
-    assert check_closure(c)
-    closure = get_value(c)
-    return closure[1]
+def eval_eqi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(i1 == i2)
 
-def make_array(v):
-    tmp = []
-    while v:
-        e, v = pop(v)
-        tmp.insert(0, e)
-    return ('Array', tmp)
+def eval_eqf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
+        raise GMLTypeError
+    stack.append(r1 == r2)
 
-def get_array(a):
-    assert check_array(a)
-    return get_value(a)
+def eval_floor(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.floor(r))
 
-def make_point(x, y, z):
-    return ('Point', (x,y,z))
+def eval_frac(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.frac(r))
 
-def get_point(p):
-    assert check_point(p)
-    return get_value(p)
+def eval_lessi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(i1 < i2)
 
-def get_point_x(p):
-    point = get_point(p)
-    return point[0]
+def eval_lessf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
+        raise GMLTypeError
+    stack.append(r1 < r2)
 
-def get_point_y(p):
-    point = get_point(p)
-    return point[1]
+def eval_modi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(modi(i1, i2))
 
-def get_point_z(p):
-    point = get_point(p)
-    return point[2]
+def eval_muli(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(i1 * i2)
 
-def get_node(obj):
-    if not isinstance(obj, primitives.Node):
+def eval_mulf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
         raise GMLTypeError
-    return obj
+    stack.append(r1 * r2)
 
-def make_stack():
-    return ()
+def eval_negi(stack):
+    i = stack.pop()
+    if type(i) is not int:
+        raise GMLTypeError
+    stack.append(-i)
 
-def push(stack, elem):
-    return (elem, stack)
+def eval_negf(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(-r)
 
-def pop(stack):
-    return stack[0], stack[1]
+def eval_real(stack):
+    i = stack.pop()
+    if type(i) is not int:
+        raise GMLTypeError
+    stack.append(float(i))
 
-def make_env():
-    return {}
-
-def add_env(env, key, value):
-    newenv = dict(env)
-    newenv[key] = value
-    return newenv
-
-def get_env(env, key):
-    return env[key]
-
-def eval_if(env, stack):
-    c2, stack = pop(stack)
-    c1, stack = pop(stack)
-    pred, stack = pop(stack)
-    if get_boolean(pred):
-        e, s, a = do_evaluate(get_closure_env(c1), stack, get_closure_function(c1))
-    else:
-        e, s, a = do_evaluate(get_closure_env(c2), stack, get_closure_function(c2))
-    return env, s
-
-def eval_apply(env, stack):
-    c, stack = pop(stack)
-    assert check_closure(c)
-    e, s, a = do_evaluate(get_closure_env(c), stack, get_closure_function(c))
-    return env, s
-
-def eval_addi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    return env, push(stack, make_integer(get_integer(i1)+get_integer(i2)))
-
-def eval_addf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    return env, push(stack, make_real(get_real(r1)+get_real(r2)))
-
-def eval_acos(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_real(math.degrees(math.acos(get_real(r)))))
-    
-def eval_asin(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_real(math.degrees(math.asin(get_real(r)))))
-
-def eval_clampf(env, stack):
-    r, stack = pop(stack)
-    rv = get_real(r)
-    if rv < 0.0:
-        rv = 0.0
-    elif rv > 1.0:
-        rv = 1.0
-    return env, push(stack, make_real(rv))
-
-def eval_cos(env, stack):
-    r, stack = pop(stack)
-    res = math.cos(math.radians(get_real(r)))
-    if abs(res) < 1e-15:
-        res = 0.0
-    return env, push(stack, make_real(res))
-
-def eval_divi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    return env, push(stack, make_integer(divi(get_integer(i1), get_integer(i2))))
-
-def eval_divf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    rv = get_real(r1) / get_real(r2)
-    return env, push(stack, make_real(rv))
-
-def eval_eqi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    rv = False
-    if get_integer(i1) == get_integer(i2):
-        rv = True        
-    return env, push(stack, make_boolean(rv))
-
-def eval_eqf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    rv = False
-    if get_real(r1) == get_real(r2):
-        rv = True        
-    return env, push(stack, make_boolean(rv))
-
-def eval_floor(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_integer(int(math.floor(get_real(r)))))
-
-def eval_frac(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_real(math.modf(get_real(r))[0]))
-
-def eval_lessi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    rv = False
-    if get_integer(i1) < get_integer(i2):
-        rv = True
-    return env, push(stack, make_boolean(rv))
-
-def eval_lessf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    rv = False
-    if get_real(r1) < get_real(r2):
-        rv = True
-    return env, push(stack, make_boolean(rv))
-
-def eval_modi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    return env, push(stack, make_integer(modi(get_integer(i1), get_integer(i2))))
-
-def eval_muli(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    return env, push(stack, make_integer(get_integer(i1)*get_integer(i2)))
-
-def eval_mulf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    return env, push(stack, make_real(get_real(r1)*get_real(r2)))
-
-def eval_negi(env, stack):
-    i, stack = pop(stack)
-    return env, push(stack, make_integer(-get_integer(i)))
-
-def eval_negf(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_real(-get_real(r)))
-
-def eval_real(env, stack):
-    i, stack = pop(stack)
-    return env, push(stack, make_real(float(get_integer(i))))
-
-def eval_sin(env, stack):
-    r, stack = pop(stack)
-    res = math.sin(math.radians(get_real(r)))
-    if abs(res) < 1e-15:
-        res = 0.0
-    return env, push(stack, make_real(res))
-
-def eval_sqrt(env, stack):
-    r, stack = pop(stack)
-    return env, push(stack, make_real(math.sqrt(get_real(r))))
-
-def eval_subi(env, stack):
-    i2, stack = pop(stack)
-    i1, stack = pop(stack)
-    return env, push(stack, make_integer(get_integer(i1)-get_integer(i2)))    
-
-def eval_subf(env, stack):
-    r2, stack = pop(stack)
-    r1, stack = pop(stack)
-    return env, push(stack, make_real(get_real(r1)-get_real(r2)))
-
-def eval_point(env, stack):
-    z, stack = pop(stack)
-    y, stack = pop(stack)
-    x, stack = pop(stack)
-    return env, push(stack, make_point(get_real(x), get_real(y), get_real(z)))
-
-def eval_getx(env, stack):
-    p, stack = pop(stack)
-    return env, push(stack, make_real(get_point_x(p)))
-
-def eval_gety(env, stack):
-    p, stack = pop(stack)
-    return env, push(stack, make_real(get_point_y(p)))
-
-def eval_getz(env, stack):
-    p, stack = pop(stack)
-    return env, push(stack, make_real(get_point_z(p)))
-
-def eval_get(env, stack):
-    i, stack = pop(stack)
-    a, stack = pop(stack)
-    iv = get_integer(i)
-    av = get_array(a)
-    if iv < 0 or iv > len(av):
+def eval_sin(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(gmlmath.sin(r))
+
+def eval_sqrt(stack):
+    r = stack.pop()
+    if type(r) is not float:
+        raise GMLTypeError
+    stack.append(math.sqrt(r))
+
+def eval_subi(stack):
+    i2 = stack.pop()
+    i1 = stack.pop()
+    if type(i1) is not int or type(i2) is not int:
+        raise GMLTypeError
+    stack.append(i1 - i2)
+
+def eval_subf(stack):
+    r2 = stack.pop()
+    r1 = stack.pop()
+    if type(r1) is not float or type(r2) is not float:
+        raise GMLTypeError
+    stack.append(r1 - r2)
+
+def eval_point(stack):
+    z = stack.pop()
+    y = stack.pop()
+    x = stack.pop()
+    if type(x) is not float or type(y) is not float or type(z) is not float:
+        raise GMLTypeError
+    stack.append((x, y, z))
+
+def eval_getx(stack):
+    p = stack.pop()
+    if type(p) is not tuple:
+        raise GMLTypeError
+    stack.append(p[0])
+
+def eval_gety(stack):
+    p = stack.pop()
+    if type(p) is not tuple:
+        raise GMLTypeError
+    stack.append(p[1])
+
+def eval_getz(stack):
+    p = stack.pop()
+    if type(p) is not tuple:
+        raise GMLTypeError
+    stack.append(p[2])
+
+def eval_get(stack):
+    i = stack.pop()
+    a = stack.pop()
+    if type(i) is not int or type(a) is not list:
+        raise GMLTypeError
+    if i < 0 or i >= len(a):
         raise GMLSubscriptError
-    try:
-        return env, push(stack, av[iv])
-    except:
-        print iv
-        raise
-
-def eval_length(env, stack):
-    a, stack = pop(stack)
-    return env, push(stack, make_integer(len(get_array(a))))
-
-def eval_sphere(env, stack):
-    surface, stack = pop(stack)
-    return env, push(stack, primitives.Sphere(get_surface(surface)))
-
-def eval_cube(env, stack):
-    surface, stack = pop(stack)
-    return env, push(stack, primitives.Cube(get_surface(surface)))
-
-def eval_cylinder(env, stack):
-    surface, stack = pop(stack)
-    return env, push(stack, primitives.Cylinder(get_surface(surface)))
-
-def eval_cone(env, stack):
-    surface, stack = pop(stack)
-    return env, push(stack, primitives.Cone(get_surface(surface)))
-
-def eval_plane(env, stack):
-    surface, stack = pop(stack)
-    return env, push(stack, primitives.Plane(get_surface(surface)))
-
-def eval_union(env, stack):
-    obj2, stack = pop(stack)
-    obj1, stack = pop(stack)
-    return env, push(stack, primitives.Union(obj1, obj2))
-
-def eval_intersect(env, stack):
-    obj2, stack = pop(stack)
-    obj1, stack = pop(stack)
-    return env, push(stack, primitives.Intersect(obj1, obj2))
-
-def eval_difference(env, stack):
-    obj2, stack = pop(stack)
-    obj1, stack = pop(stack)
-    return env, push(stack, primitives.Difference(obj1, obj2))
-
-def eval_translate(env, stack):
-    tz, stack = pop(stack)
-    ty, stack = pop(stack)
-    tx, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.translate(get_real(tx), get_real(ty), get_real(tz))
-    return env, push(stack, obj)
-
-def eval_scale(env, stack):
-    sz, stack = pop(stack)
-    sy, stack = pop(stack)
-    sx, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.scale(get_real(sx), get_real(sy), get_real(sz))
-    return env, push(stack, obj)
-
-def eval_uscale(env, stack):
-    s, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.uscale(get_real(s))
-    return env, push(stack, obj)
-
-def eval_rotatex(env, stack):
-    d, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.rotatex(get_real(d))
-    return env, push(stack, obj)
-
-def eval_rotatey(env, stack):
-    d, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.rotatey(get_real(d))
-    return env, push(stack, obj)
-
-def eval_rotatez(env, stack):
-    d, stack = pop(stack)
-    obj, stack = pop(stack)
-    obj.rotatez(get_real(d))
-    return env, push(stack, obj)
-
-def eval_light(env, stack):
-    color, stack = pop(stack)
-    d, stack = pop(stack)
-    return env, push(stack, lights.Light(get_point(d),
-                                         get_point(color)))
-
-def eval_pointlight(env, stack):
-    color, stack = pop(stack)
-    pos, stack = pop(stack)
-    return env, push(stack, lights.PointLight(get_point(pos),
-                                              get_point(color)))
-
-def eval_spotlight(env, stack):
-    exp, stack = pop(stack)
-    cutoff, stack = pop(stack)
-    color, stack = pop(stack)
-    at, stack = pop(stack)
-    pos, stack = pop(stack)
-    return env, push(stack, lights.SpotLight(get_point(pos),
-                                             get_point(at),
-                                             get_point(color),
-                                             get_real(cutoff),
-                                             get_real(exp)))
-
-def eval_render(env, stack):
-    file, stack = pop(stack)
-    ht, stack = pop(stack)
-    wid, stack = pop(stack)
-    fov, stack = pop(stack)
-    depth, stack = pop(stack)
-    obj, stack = pop(stack)
-    lights, stack = pop(stack)
-    amb, stack = pop(stack)
-    raytracer.render(get_point(amb),
-                     get_array(lights),
-                     get_node(obj),
-                     get_integer(depth),
-                     get_real(fov),
-                     get_integer(wid),
-                     get_integer(ht),
-                     get_string(file))
-    return env, stack
+    stack.append(a[i])
+
+def eval_length(stack):
+    a = stack.pop()
+    if type(a) is not list:
+        raise GMLTypeError
+    stack.append(len(a))
+
+# The operators without their checks, for the sites the type checker
+# proves to get operands of their types, made from the expressions of
+# the surface compiler
+def make_unchecked(name, argtypes, expr):
+    params = tuple(["a%d" % i for i in range(len(argtypes))])
+    source = "def eval_%s(stack):\n" % name
+    for param in reversed(params):
+        source += "    %s = stack.pop()\n" % param
+    source += "    stack.append(%s)\n" % (expr % params)
+    namespace = dict(surfacecompiler.runtime)
+    exec source in namespace
+    return namespace["eval_" + name]
+
+unchecked = dict((name, make_unchecked(name, argtypes, expr)) for
+                 name, (argtypes, restype, expr) in surfacecompiler.operators.items())
+
+def eval_sphere(stack):
+    surface = stack.pop()
+    stack.append(primitives.Sphere(get_surface(surface)))
+
+def eval_cube(stack):
+    surface = stack.pop()
+    stack.append(primitives.Cube(get_surface(surface)))
+
+def eval_cylinder(stack):
+    surface = stack.pop()
+    stack.append(primitives.Cylinder(get_surface(surface)))
+
+def eval_cone(stack):
+    surface = stack.pop()
+    stack.append(primitives.Cone(get_surface(surface)))
+
+def eval_plane(stack):
+    surface = stack.pop()
+    stack.append(primitives.Plane(get_surface(surface)))
+
+def eval_union(stack):
+    obj2 = stack.pop()
+    obj1 = stack.pop()
+    stack.append(primitives.Union(get_node(obj1), get_node(obj2)))
+
+def eval_intersect(stack):
+    obj2 = stack.pop()
+    obj1 = stack.pop()
+    stack.append(primitives.Intersect(get_node(obj1), get_node(obj2)))
+
+def eval_difference(stack):
+    obj2 = stack.pop()
+    obj1 = stack.pop()
+    stack.append(primitives.Difference(get_node(obj1), get_node(obj2)))
+
+def eval_translate(stack):
+    tz = stack.pop()
+    ty = stack.pop()
+    tx = stack.pop()
+    obj = stack.pop()
+    if type(tx) is not float or type(ty) is not float or type(tz) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).translate(tx, ty, tz))
+
+def eval_scale(stack):
+    sz = stack.pop()
+    sy = stack.pop()
+    sx = stack.pop()
+    obj = stack.pop()
+    if type(sx) is not float or type(sy) is not float or type(sz) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).scale(sx, sy, sz))
+
+def eval_uscale(stack):
+    s = stack.pop()
+    obj = stack.pop()
+    if type(s) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).uscale(s))
+
+def eval_rotatex(stack):
+    d = stack.pop()
+    obj = stack.pop()
+    if type(d) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).rotatex(d))
+
+def eval_rotatey(stack):
+    d = stack.pop()
+    obj = stack.pop()
+    if type(d) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).rotatey(d))
+
+def eval_rotatez(stack):
+    d = stack.pop()
+    obj = stack.pop()
+    if type(d) is not float:
+        raise GMLTypeError
+    stack.append(get_node(obj).rotatez(d))
+
+def eval_light(stack):
+    color = stack.pop()
+    d = stack.pop()
+    if type(d) is not tuple or type(color) is not tuple:
+        raise GMLTypeError
+    stack.append(lights.Light(d, color))
+
+def eval_pointlight(stack):
+    color = stack.pop()
+    pos = stack.pop()
+    if type(pos) is not tuple or type(color) is not tuple:
+        raise GMLTypeError
+    stack.append(lights.PointLight(pos, color))
+
+def eval_spotlight(stack):
+    exp = stack.pop()
+    cutoff = stack.pop()
+    color = stack.pop()
+    at = stack.pop()
+    pos = stack.pop()
+    if type(pos) is not tuple or type(at) is not tuple or type(color) is not tuple or \
+       type(cutoff) is not float or type(exp) is not float:
+        raise GMLTypeError
+    stack.append(lights.SpotLight(pos, at, color, cutoff, exp))
+
+def eval_render(stack):
+    file = stack.pop()
+    ht = stack.pop()
+    wid = stack.pop()
+    fov = stack.pop()
+    depth = stack.pop()
+    obj = stack.pop()
+    lightlist = stack.pop()
+    amb = stack.pop()
+    if type(amb) is not tuple or type(lightlist) is not list or \
+       type(depth) is not int or type(fov) is not float or \
+       type(wid) is not int or type(ht) is not int or type(file) is not str:
+        raise GMLTypeError
+    for light in lightlist:
+        if not isinstance(light, light_types):
+            raise GMLTypeError
+    raytracer.render(amb, lightlist, get_node(obj), depth, fov, wid, ht, file)
 
 def get_surface(surface):
-    assert check_closure(surface)
+    check_closure(surface)
+    try:
+        code = surface.code
+        f = surfacecompiler.compile_surface(code.environment(surface.env),
+                                            code.ast)
+    except surfacecompiler.CompileError:
+        pass
+    else:
+        if profiler is not None:
+            f = profiler.surface(profiler.key(code.ast), f)
+        return f
     def do_surface(face, u, v):
-        stack = make_stack()
-        stack = push(stack, make_integer(face))
-        stack = push(stack, make_real(u))
-        stack = push(stack, make_real(v))
-        e, stack, a = do_evaluate(get_closure_env(surface),
-                                  stack,
-                                  get_closure_function(surface))
-        n, stack = pop(stack)
-        ks, stack = pop(stack)
-        kd, stack = pop(stack)
-        sc, stack = pop(stack)
-        return get_point(sc), get_real(kd), get_real(ks), get_real(n)
+        e, stack = do_evaluate(surface.env, [face, u, v], surface.code)
+        n = stack.pop()
+        ks = stack.pop()
+        kd = stack.pop()
+        sc = stack.pop()
+        return sc, kd, ks, n
     return do_surface
 
-def do_evaluate(env, stack, ast):
-    while ast:        
-        node = ast[0]
-        ast = ast[1:]
-        t, v = node
-        if t in ['Integer', 'Real', 'Boolean', 'String']:
-            stack = push(stack, node)
+# The parse tree is compiled to flat code before it is evaluated.
+# Every instruction is an opcode and an argument, with the operators
+# resolved to their eval_ functions, names to their frame and slot,
+# and function and array literals compiled once to nested code.
+# Literal closures that are applied or passed to if straight away are
+# inlined, with if turned into jumps, and their binders get slots in
+# the frame of the code they are inlined into. The other applies and
+# ifs are calls, which are tail calls (TAILAPPLY and TAILIF) when
+# nothing is left to run after them. The applies and ifs the type
+# checker proved to get closures and booleans skip those checks:
+# inline ifs use JUMPIFFALSE, and calls get True as their argument.
+# The operators it proved to get operands of their types are the
+# unchecked ones.
+# When profiler is set, every code starts with ENTER and ends with
+# LEAVE, which leaves no tail calls, calls are between ENTER and LEAVE
+# too, and the operators are timed by the profiler. When memo_size is
+# set, the closure bodies, and the inline ones, that memo finds pure
+# are between MEMO, which pushes their results and skips them if they
+# are cached for the values they pop, and MEMOSTORE, which caches them.
+# Values marshal can't key, and caches memo has turned off, run the
+# body uncached.
+(PUSH, BIND, LOCAL, LOOKUP, FREE, CLOSURE, ARRAY, CALL, JUMP, JUMPIFNOT,
+ JUMPIFFALSE, ENTER, LEAVE, MEMO, MEMOSTORE, APPLY, TAILAPPLY, IF,
+ TAILIF) = range(19)
+
+# a gmlprofile.Profiler, to profile the programs evaluated
+profiler = None
+
+# the number of results cached for each pure body, and the caches, by
+# the id of the body, with the body, which is shared by the copies the
+# constant folder makes of it
+memo_size = 0
+memo_caches = {}
+
+def memo_counts():
+    # the hits and misses of all the caches
+    return (sum(c.hits for ast, c in memo_caches.values()),
+            sum(c.misses for ast, c in memo_caches.values()))
+
+class Code(object):
+    def __init__(self, ast, outer):
+        # the parse tree is kept for the surface compiler
+        self.ast = ast
+        # the scope the closures of the code are made in
+        self.outer = outer
+        self.scope = None
+        self.nslots = 0
+        self.ops = []
+        self.args = []
+        # whether the code being compiled is in a cached body
+        self.memoized = False
+
+    def emit(self, op, arg=None):
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def environment(self, env):
+        # the names a closure of the code made with env can see
+        return Environment(self.outer, env)
+
+def unimplemented(stack):
+    raise KeyError
+
+def compile_body(code, ast, scope, proven):
+    i = 0
+    n = len(ast)
+    while i < n:
+        t, v = ast[i]
+        i += 1
+        if t in ['Integer', 'Real', 'Boolean', 'String', 'Point']:
+            code.emit(PUSH, v)
         elif t == 'Binder':
-            i, stack = pop(stack)
-            env = add_env(env, v, i)
+            code.emit(BIND, code.nslots)
+            scope = scope.bind(v, code.nslots)
+            code.nslots += 1
         elif t == 'Identifier':
-            try:
-                e = get_env(env, v)
-                if isinstance(e, primitives.Node):
-                    e = copy.deepcopy(e)
-                stack = push(stack, e)
-            except KeyError:
-                raise GMLRuntimeError
+            r = scope.resolve(v)
+            if r is None:
+                code.emit(FREE, v)
+            elif r[0] == 0:
+                code.emit(LOCAL, r[1])
+            else:
+                code.emit(LOOKUP, r)
         elif t == 'Function':
-            c = make_closure(env, v)
-            stack = push(stack, c)
+            if ast[i:i + 1] == [('Operator', 'apply')]:
+                compile_inline(code, v, scope, proven)
+                i += 1
+            elif i + 1 < n and ast[i][0] == 'Function' and \
+                 ast[i + 1] == ('Operator', 'if'):
+                if (id(ast), i + 1) in proven:
+                    jumpifnot = code.emit(JUMPIFFALSE)
+                else:
+                    jumpifnot = code.emit(JUMPIFNOT)
+                compile_inline(code, v, scope, proven)
+                jump = code.emit(JUMP)
+                code.args[jumpifnot] = len(code.ops)
+                compile_inline(code, ast[i][1], scope, proven)
+                code.args[jump] = len(code.ops)
+                i += 2
+            else:
+                code.emit(CLOSURE, compile_code(v, scope, proven, True))
         elif t == 'Array':
-            e, s, a = do_evaluate(env, make_stack(), v)
-            stack = push(stack, make_array(s))
+            code.emit(ARRAY, compile_code(v, scope, proven))
+        elif t == 'Operator' and v in ['apply', 'if']:
+            if profiler is not None:
+                code.emit(ENTER, ('~', 0, v))
+            if v == 'apply':
+                code.emit(APPLY, (id(ast), i - 1) in proven or None)
+            else:
+                code.emit(IF, (id(ast), i - 1) in proven or None)
+            if profiler is not None:
+                code.emit(LEAVE)
         elif t == 'Operator':
-            env, stack = globals()["eval_"+v](env, stack)
-    return env, stack, ast
-
-def evaluate(ast):    
-    return do_evaluate(make_env(), make_stack(), ast)
+            if v in unchecked and (id(ast), i - 1) in proven:
+                f = unchecked[v]
+            else:
+                f = globals().get("eval_"+v, unimplemented)
+            if profiler is not None:
+                f = profiler.operator(v, f)
+            code.emit(CALL, f)
+        else:
+            raise GMLRuntimeError
+    return scope
+
+def compile_inline(code, ast, scope, proven):
+    # compiles a body that is run in place, cached if it is pure
+    effect = None
+    if memo_size and not code.memoized:
+        effect = memo.effect(ast)
+    if effect is None:
+        return compile_body(code, ast, scope, proven)
+    if id(ast) not in memo_caches:
+        memo_caches[id(ast)] = (ast, memo.LRUCache(memo_size, *effect))
+    cache = memo_caches[id(ast)][1]
+    start = code.emit(MEMO)
+    code.memoized = True
+    scope = compile_body(code, ast, scope, proven)
+    code.memoized = False
+    code.emit(MEMOSTORE, cache)
+    code.args[start] = (cache, len(code.ops))
+    return scope
+
+def is_tail(code, pc):
+    # whether the code ends when it continues at pc
+    ops = code.ops
+    n = len(ops)
+    while pc < n and ops[pc] == JUMP:
+        pc = code.args[pc]
+    return pc >= n
+
+def compile_code(ast, outer=None, proven=(), closure=False):
+    # proven is what typechecker.check returned for the program
+    code = Code(ast, outer)
+    if profiler is not None:
+        code.emit(ENTER, profiler.key(ast))
+    if closure:
+        code.scope = compile_inline(code, ast, Scope({}, outer), proven)
+    else:
+        code.scope = compile_body(code, ast, Scope({}, outer), proven)
+    if profiler is not None:
+        code.emit(LEAVE)
+    for pc, op in enumerate(code.ops):
+        if op in [APPLY, IF] and is_tail(code, pc + 1):
+            code.ops[pc] = op == APPLY and TAILAPPLY or TAILIF
+    return code
+
+def do_evaluate(env, stack, code):
+    # Runs code with its own frame on top of env. Calls don't recurse:
+    # the code, position and frame of the caller are saved on calls
+    # and restored when the callee ends, and tail calls save nothing,
+    # so loops run in constant stack. An array literal is run like a
+    # call that saves the height of the stack, and the values above
+    # it when it ends are the elements. Returns the environment of
+    # the code and the stack.
+    push = stack.append
+    pop = stack.pop
+    calls = []
+    ops = code.ops
+    args = code.args
+    n = len(ops)
+    pc = 0
+    frame = [None] * code.nslots
+    env = top = (frame, env)
+    while True:
+        while pc < n:
+            op = ops[pc]
+            arg = args[pc]
+            pc += 1
+            if op == CALL:
+                arg(stack)
+            elif op == LOCAL:
+                push(frame[arg])
+            elif op == PUSH:
+                push(arg)
+            elif op == BIND:
+                frame[arg] = pop()
+            elif op == LOOKUP:
+                push(get_env(env, arg[0], arg[1]))
+            elif op == JUMPIFNOT:
+                pred = pop()
+                if pred is not True:
+                    check_boolean(pred)
+                    pc = arg
+            elif op == JUMPIFFALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+            elif op == CLOSURE:
+                push(Closure(env, arg))
+            elif op >= APPLY:
+                if op == APPLY or op == TAILAPPLY:
+                    c = pop()
+                else:
+                    c2 = pop()
+                    c1 = pop()
+                    pred = pop()
+                    if arg is None:
+                        check_boolean(pred)
+                    if pred:
+                        c = c1
+                    else:
+                        c = c2
+                if arg is None:
+                    check_closure(c)
+                if op == APPLY or op == IF:
+                    calls.append((ops, args, pc, frame, env, None))
+                callee = c.code
+                ops = callee.ops
+                args = callee.args
+                n = len(ops)
+                pc = 0
+                frame = [None] * callee.nslots
+                env = (frame, c.env)
+            elif op == ARRAY:
+                calls.append((ops, args, pc, frame, env, len(stack)))
+                ops = arg.ops
+                args = arg.args
+                n = len(ops)
+                pc = 0
+                frame = [None] * arg.nslots
+                env = (frame, env)
+            elif op == FREE:
+                raise GMLRuntimeError
+            elif op == ENTER:
+                profiler.enter(arg)
+            elif op == LEAVE:
+                profiler.leave()
+            elif op == MEMO:
+                cache, end = arg
+                key = None
+                height = len(stack) - cache.nargs
+                if height >= 0 and cache.active:
+                    try:
+                        key = memo.key(tuple(stack[height:]))
+                    except ValueError:
+                        # a closure, object or light, that the body
+                        # binds and doesn't use, runs it uncached
+                        pass
+                    else:
+                        res = cache.get(key)
+                        if res is not None:
+                            stack[height:] = res
+                            pc = end
+            elif op == MEMOSTORE:
+                if key is not None:
+                    arg.put(key, stack[len(stack) - arg.nresults:])
+        if not calls:
+            return top, stack
+        ops, args, pc, frame, env, height = calls.pop()
+        n = len(ops)
+        if height is not None:
+            if len(stack) < height:
+                # the literal popped values from below its start
+                raise IndexError
+            a = stack[height:]
+            del stack[height:]
+            push(a)
+
+def evaluate(ast, check_types=False, prelude=None):
+    # returns the names bound at the top level and the stack, with
+    # those of the prelude if ast is run after one
+    if prelude is None:
+        ast = partialeval.fold(ast)
+        outer = None
+        env = make_env()
+        stack = make_stack()
+    else:
+        ast = partialeval.fold(ast, prelude.consts)
+        outer = prelude.scope
+        env = prelude.env
+        stack = list(prelude.stack)
+    if profiler is not None:
+        profiler.scan(ast)
+    if check_types:
+        if prelude is None:
+            proven = typechecker.check(ast)
+        else:
+            proven = typechecker.check(ast, *prelude.types())
+        code = compile_code(ast, outer, proven)
+    else:
+        code = compile_code(ast, outer)
+    env, stack = do_evaluate(env, stack, code)
+    return Environment(code.scope, env), stack
+
+def value_type(value):
+    # the type checker's type of a value, or None
+    t = type(value)
+    if t is bool:
+        return 'Boolean'
+    elif t is int:
+        return 'Integer'
+    elif t is float:
+        return 'Real'
+    elif t is str:
+        return 'String'
+    elif t is tuple:
+        return 'Point'
+    return None
+
+# The version of the tokenizer, parser, folder and type checker that
+# made the programs saved by preludes, with the arithmetic the folder
+# does on their constants
+prelude_version = hashlib.sha1(preprocess.version + "".join(
+    [open(os.path.splitext(m.__file__)[0] + ".py").read()
+     for m in [tokenizer, parser, partialeval, surfacecompiler, typechecker,
+               gmlmath]])).hexdigest()
+
+class Prelude(object):
+    # Library files evaluated once, in order, for scenes that start by
+    # including them. A scene run after the prelude starts from the
+    # names the libraries bound, their values and the stack they left,
+    # and is folded with the constants they bound, as if it followed
+    # them. Values are never changed once made, so the scenes can share
+    # them. The folded libraries are also saved in preprocess.disk_cache,
+    # when it is set, and only compiled and run again by later runs.
+    def __init__(self, files):
+        files = [os.path.abspath(f) for f in files]
+        defines = set()
+        self.chunks = []
+        for f in files:
+            self.chunks.extend(preprocess.nonempty(preprocess.chunks(f, defines)))
+        digest = hashlib.sha1(repr((files, [(c.path, c.line, c.text)
+                                            for c in self.chunks])))
+        self.name = "prelude-%s.gmlc" % hashlib.sha1(repr(files)).hexdigest()[:16]
+        self.header = "%s %s\n" % (prelude_version, digest.hexdigest())
+        saved = None
+        if preprocess.disk_cache is not None:
+            saved = preprocess.read_cache(self.name, self.header)
+        if saved is None:
+            ast = parser.parse(preprocess.tokens(self.chunks))
+            self.consts = {}
+            ast = partialeval.Folder().fold_body(ast, self.consts, [])
+            if preprocess.disk_cache is not None:
+                self.save(ast)
+        else:
+            ast = [parser.decode(node) for node in saved[0]]
+            self.consts = dict([(name, parser.decode(node))
+                                for name, node in saved[1].items()])
+        if profiler is not None:
+            profiler.scan(ast)
+        code = compile_code(ast)
+        self.scope = code.scope
+        self.env, self.stack = do_evaluate(make_env(), make_stack(), code)
+
+    def save(self, ast):
+        preprocess.write_cache(self.name, self.header,
+                               ([parser.encode(node) for node in ast],
+                                dict([(name, parser.encode(node))
+                                      for name, node in self.consts.items()])))
+
+    def types(self):
+        # the types of the names and the stack, for the type checker
+        frame = self.env[0]
+        scope = dict([(name, value_type(frame[slot]))
+                      for name, slot in self.scope.names.items()])
+        return scope, [value_type(v) for v in self.stack]
+
+    def parse(self, filename):
+        # the parse tree of the scene after the prelude, or None if it
+        # doesn't start with the files of the prelude, or has nothing
+        # after them
+        tokens = preprocess.tokens_after(filename, self.chunks)
+        if tokens is None:
+            return None
+        for first in tokens:
+            return parser.parse(itertools.chain([first], tokens))
+        return None
+
+def run_file(filename, check_types=False, preludes=(), times=None):
+    # Evaluates the scene in filename, after the first of preludes it
+    # starts by including, and prints what went wrong if the program
+    # did. times, if given, gets the time it took to parse and to
+    # evaluate. Returns the prelude it used, if any.
+    start = time.time()
+    prelude = None
+    try:
+        ast = None
+        for p in preludes:
+            ast = p.parse(filename)
+            if ast is not None:
+                prelude = p
+                break
+        if ast is None:
+            ast = parser.parse(preprocess.preprocess_tokens(filename))
+        parsed = time.time()
+        try:
+            evaluate(ast, check_types, prelude)
+        finally:
+            if times is not None:
+                times['parse'] = parsed - start
+                times['evaluate'] = time.time() - parsed
+    except preprocess.PreprocessError, e:
+        print "preprocessor error:", e
+    except parser.GMLSyntaxError:
+        print "contains syntax errors"
+    except typechecker.TypeCheckError, e:
+        print "type error:", e
+    except GMLRuntimeError:
+        print "runtime error"
+    except GMLSubscriptError:
+        print "array index out of range"
+    except GMLTypeError:
+        print "type error"
+    except KeyError:
+        print "contains unimplemented feature"
+    finally:
+        # the entries an error left running aren't the callers of the
+        # next file's
+        if profiler is not None:
+            profiler.stop()
+    return prelude
 
 def test(ast, res):    
     try:
@@ -506,14 +923,51 @@ def run(gml):
     return evaluate(parse(tokenize(gml)))
 
 if __name__=="__main__":
-    from preprocess import preprocess
+    from preprocess import PreprocessError
     from tokenizer import tokenize
     from parser import parse, GMLSyntaxError
     import sys
 
-    sys.setrecursionlimit(120000)
-
-    psyco = (sys.argv[1] == "-p")
+    if "-j" in sys.argv:
+        i = sys.argv.index("-j")
+        raytracer.workers = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    check_types = "-t" in sys.argv
+    if check_types:
+        sys.argv.remove("-t")
+
+    # --profile file saves a profile of the programs for pstats, and
+    # prints a report of it
+    profile = None
+    if "--profile" in sys.argv:
+        i = sys.argv.index("--profile")
+        profile = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+        profiler = gmlprofile.Profiler()
+
+    # --memo size caches the results of pure code
+    if "--memo" in sys.argv:
+        i = sys.argv.index("--memo")
+        memo_size = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # --cache directory saves the tokenized files and the preludes
+    # there for later runs
+    if "--cache" in sys.argv:
+        i = sys.argv.index("--cache")
+        preprocess.disk_cache = os.path.abspath(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # --prelude files evaluates the library files, separated by commas,
+    # once, for the scenes that start by including them
+    prelude_files = None
+    if "--prelude" in sys.argv:
+        i = sys.argv.index("--prelude")
+        prelude_files = sys.argv[i + 1].split(",")
+        del sys.argv[i:i + 2]
+
+    psyco = (len(sys.argv) > 1 and sys.argv[1] == "-p")
     if psyco:
         files = sys.argv[2:]
     else:
@@ -529,48 +983,134 @@ if __name__=="__main__":
         except ImportError:
             print "psyco not installed"
             pass
+
+    prelude = None
+    if prelude_files is not None:
+        if profiler is not None:
+            profiler.filename = os.path.abspath(prelude_files[0])
+        try:
+            prelude = Prelude(prelude_files)
+        except (PreprocessError, GMLSyntaxError, GMLRuntimeError,
+                GMLSubscriptError, GMLTypeError, KeyError), e:
+            print "prelude error:", e.__class__.__name__, e
+            sys.exit(1)
     
     for f in files:
         print f
         print "=" * len(f)
-        try:
-            r = evaluate(parse(tokenize(preprocess(f))))
-        except GMLSyntaxError:
-            print "contains syntax errors"
-        except GMLRuntimeError:
-            print "runtime error"
-        except GMLSubscriptError:
-            print "array index out of range"
-        except KeyError:
-            print "contains unimplemented feature"
+        if profiler is not None:
+            profiler.filename = os.path.abspath(f)
+        run_file(f, check_types, prelude and [prelude] or [])
+        if memo_size:
+            print "memo: %d hits, %d misses" % memo_counts()
+            memo_caches.clear()
         print
 
+    if profile is not None:
+        profiler.dump_stats(profile)
+        print profiler.report()
+
     if files:
         sys.exit(0)
 
     # Run some tests
-    env, stack, ast = run("1 /x")
+    env, stack = run("1 /x")
     print env['x']
-    env, stack, ast = run("true { 1 } { 2 } if")
+    env, stack = run("true { 1 } { 2 } if")
     print stack
-    env, stack, ast = run("false { 1 } { 2 } if")
+    env, stack = run("false { 1 } { 2 } if")
     print stack
-    env, stack, ast = run("false /b b { 1 } { 2 } if")
+    env, stack = run("false /b b { 1 } { 2 } if")
     print stack
-    env, stack, ast = run("1 { /x x x } apply")
+    env, stack = run("1 { /x x x } apply")
     print stack
-    env, stack, ast = run("1 2 addi")
+    env, stack = run("1 2 addi")
     print stack
-    env, stack, ast = run("4 /x 2 x addi")
+    env, stack = run("4 /x 2 x addi")
     print stack
-    env, stack, ast = run("1 { /x x x } apply addi")
+    env, stack = run("1 { /x x x } apply addi")
     print stack
-    env, stack, ast = run("{ /x x x } /dup { dup apply muli } /sq 3 sq apply")
+    env, stack = run("{ /x x x } /dup { dup apply muli } /sq 3 sq apply")
     print stack
-    env, stack, ast = run("{ /x /y x y } /swap 3 4 swap apply")
+    env, stack = run("{ /x /y x y } /swap 3 4 swap apply")
     print stack
-    env, stack, ast = run("{ /self /n n 2 lessi { 1 } { n 1 subi self self apply n muli } if } /fact 12 fact fact apply")
+    env, stack = run("{ /self /n n 2 lessi { 1 } { n 1 subi self self apply n muli } if } /fact 12 fact fact apply")
     print stack
+    env, stack = run("1 /x { x } /f 2 /x f apply")
+    print stack
+    env, stack = run("1 /x true { 2 /x x } { 3 /x x } if x")
+    print stack
+    # with the checks the type checker proves dropped
+    ast = parse(tokenize("{ /self /n n 2 lessi { 1 } { n 1 subi self self apply n muli } if } /fact 12 fact fact apply"))
+    env, stack = evaluate(ast, True)
+    print stack
+    ast = parse(tokenize("3 /n { 1 } /a { 2 } /b n 2 lessi a b if"))
+    env, stack = evaluate(ast, True)
+    print stack
+    try:
+        evaluate(parse(tokenize("1 2.0 addi")), True)
+        print "type error not found"
+    except typechecker.TypeCheckError:
+        pass
+    ast = parse(tokenize("[ 3 ] 0 get /n n n muli 2 addi"))
+    code = compile_code(ast, None, typechecker.check(ast))
+    print unchecked['muli'] in code.args, unchecked['addi'] in code.args
+    # but not where a copy of the same body isn't proven
+    ast = parse(tokenize("{ /c c { 1 } { 2 } if } /f "
+                         "[ 1 ] 0 get 2 lessi f apply [ 1 true ] 0 get f apply"))
+    for check_types in [False, True]:
+        try:
+            evaluate(ast, check_types)
+            print "type error not found"
+        except GMLTypeError:
+            pass
+    # and without
+    for prog in ["1 2.0 addi", "1.0 2 addf", "true 1 lessi", "1 getx",
+                 "[ 1 ] 0.0 get", "1 length", "1 1.0 2.0 3.0 translate",
+                 "{ } sphere 1 2.0 3.0 translate", "{ } sphere 1 rotatex",
+                 "{ } sphere 1 union", "1.0 1.0 1.0 point 1.0 light",
+                 "1.0 1.0 1.0 point [ 1 ] { } sphere 1 90.0 8 8 \"x.ppm\" render"]:
+        try:
+            run(prog)
+            print prog, "type error not found"
+        except GMLTypeError:
+            pass
+    try:
+        run("[ 1 ] 1 get")
+        print "subscript error not found"
+    except GMLSubscriptError:
+        pass
+    # profiled
+    profiler = gmlprofile.Profiler()
+    env, stack = run("{ /x x x muli } /sq [ 3 ] 0 get sq apply sq apply")
+    print stack, profiler.entries[('~', 0, 'muli')][:2]
+    profiler = None
+    # memoized
+    memo_size = 10
+    env, stack = run("{ /x x real 2.0 mulf 1.0 addf sqrt } /f [ 3 3 ] /a a 0 get f apply a 1 get f apply")
+    print stack, memo_counts()
+    env, stack = run("{ /f /x x x mulf x mulf x mulf x addf } /g 2.0 { } g apply")
+    print stack
+    memo_size = 0
+    # after a prelude, and one saved by an earlier run
+    import tempfile
+    import shutil
+    d = tempfile.mkdtemp()
+    preprocess.disk_cache = os.path.join(d, "cache")
+    try:
+        lib = os.path.join(d, "lib.ins")
+        scene = os.path.join(d, "scene.gml")
+        open(lib, "w").write("{ /x x x muli } /sq 3 /three 7\n")
+        open(scene, "w").write('% a scene\n#include "lib.ins"\nthree sq apply\n')
+        for i in range(2):
+            prelude = Prelude([lib])
+            env, stack = evaluate(prelude.parse(scene), True, prelude)
+            print stack, env['three']
+        print prelude.parse(lib), Prelude([scene]).parse(scene)
+        print len(os.listdir(preprocess.disk_cache)), sorted(os.listdir(d))
+    finally:
+        preprocess.disk_cache = None
+        shutil.rmtree(d)
     for u in range(10):
         for v in range(10):
             prog = """1 /col1 2 /col2 %f /u %f /v { /y /x x x mulf y y mulf addf sqrt } /dist
@@ -597,7 +1137,16 @@ if __name__=="__main__":
                 else:
                     print 2,
             #test(u / 10.0, v / 10.0)
-            env, stack, ast = run(prog)
+            # u = v = 0.5 divides by a distance of zero
+            try:
+                env, stack = run(prog)
+            except ZeroDivisionError:
+                if (u, v) != (5, 5):
+                    raise
+                print "/0",
+                continue
+            if (u, v) == (5, 5):
+                print "division by zero not found",
             print stack,
         print
     
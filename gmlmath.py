@@ -0,0 +1,60 @@
+import math
+
+# The numeric semantics of the GML operators that don't map directly
+# to a Python operator, shared by the evaluator and the surface compiler
+
+def divi(a, b):
+    rv = a // b
+    if rv < 0:
+        rv += 1 # we need to round towards zero, which python doesn't
+    return rv
+
+def modi(a, b):
+    return a - b * divi(a, b)
+
+def acos(r):
+    return math.degrees(math.acos(r))
+
+def asin(r):
+    return math.degrees(math.asin(r))
+
+def clampf(r):
+    if r < 0.0:
+        r = 0.0
+    elif r > 1.0:
+        r = 1.0
+    return r
+
+def cos(r):
+    res = math.cos(math.radians(r))
+    if abs(res) < 1e-15:
+        res = 0.0
+    return res
+
+def sin(r):
+    res = math.sin(math.radians(r))
+    if abs(res) < 1e-15:
+        res = 0.0
+    return res
+
+def floor(r):
+    return int(math.floor(r))
+
+def frac(r):
+    return math.modf(r)[0]
+
+sqrt = math.sqrt
+
+if __name__=="__main__":
+    def test(v, res):
+        if v != res:
+            print v, "!=", res
+
+    test(divi(7, 2), 3)
+    test(divi(-7, 2), -3)
+    test(modi(-7, 2), -1)
+    test(cos(90.0), 0.0)
+    test(sin(180.0), 0.0)
+    test(clampf(1.5), 1.0)
+    test(floor(-0.5), -1)
+    test(frac(-1.25), -0.25)
@@ -0,0 +1,240 @@
+import marshal
+import time
+
+# Counts and times what a GML program runs, when it is evaluated with
+# evaluator.profiler set to a Profiler. Every operator, and every
+# closure and array literal, is an entry keyed like a Python function
+# in a profile of the profile module, (file, line, name): operators
+# are ('~', 0, name), apply and if included, and literals are (file,
+# line, label), where the literal starts in the source, and the label
+# is the name the literal is bound to, or the start of its source.
+# Literals the parser gave no position are on line 0. The program
+# itself is (file, 0, '<program>').
+# The entries record their calls, their own time, their total time
+# and their callers, and can be saved for pstats (and prof.py) or
+# printed as a text report.
+
+timer = time.time
+
+def source(ast, limit):
+    # the GML source of the first limit nodes of ast
+    words = []
+    for t, v in ast[:limit]:
+        if t == 'Binder':
+            words.append('/' + v)
+        elif t == 'Boolean':
+            words.append(v and 'true' or 'false')
+        elif t == 'String':
+            words.append('"%s"' % v)
+        elif t == 'Point':
+            words.append('%r %r %r point' % v)
+        elif t == 'Function':
+            words.append('{ %s }' % source(v, 0))
+        elif t == 'Array':
+            words.append('[ %s ]' % source(v, 0))
+        else:
+            words.append(str(v))
+    if len(ast) > limit:
+        words.append('...')
+    return ' '.join(words)
+
+class Profiler(object):
+    def __init__(self, filename='<gml>'):
+        self.filename = filename
+        # id of a literal's body: its key
+        self.keys = {}
+        # key of a literal: the column it starts in
+        self.columns = {}
+        # key: [primitive calls, calls, own time, total time,
+        #       {caller: [calls, primitive calls, own time, total time]}]
+        self.entries = {}
+        # the running entries, as [key, start, time of the callees]
+        self.running = []
+        # key: how many times the entry is running
+        self.active = {}
+
+    def scan(self, ast):
+        # names the literals of the program ast
+        self.keys[id(ast)] = (self.filename, 0, '<program>')
+        self.do_scan(ast)
+
+    def do_scan(self, ast):
+        for i, (t, v) in enumerate(ast):
+            if t not in ['Function', 'Array'] or id(v) in self.keys:
+                continue
+            if ast[i + 1:i + 2] and ast[i + 1][0] == 'Binder':
+                label = '/' + ast[i + 1][1]
+            elif t == 'Function':
+                label = '{ %s }' % source(v, 4)
+            else:
+                label = '[ %s ]' % source(v, 4)
+            self.keys[id(v)] = self.literal_key(v, label)
+            self.do_scan(v)
+
+    def literal_key(self, body, label):
+        # The key of the literal with body. Copies of a literal made by
+        # the folder share its key, and different literals with the same
+        # label on a line are told apart by their column.
+        position = getattr(body, 'position', None)
+        if position is None:
+            filename, line, column = self.filename, 0, len(self.keys)
+        else:
+            line, column = position[:2]
+            filename = position[2:] and position[2] or self.filename
+        key = (filename, line, label)
+        if self.columns.setdefault(key, column) != column:
+            key = (filename, line, '%s@%d' % (label, column))
+        return key
+
+    def key(self, ast):
+        if id(ast) not in self.keys:
+            self.keys[id(ast)] = self.literal_key(ast, '{ %s }' % source(ast, 4))
+        return self.keys[id(ast)]
+
+    def enter(self, key):
+        self.running.append([key, timer(), 0.0])
+        self.active[key] = self.active.get(key, 0) + 1
+
+    def leave(self):
+        key, start, callees = self.running.pop()
+        total = timer() - start
+        own = total - callees
+        if self.running:
+            caller = self.running[-1]
+            caller[2] += total
+            caller = caller[0]
+        else:
+            caller = None
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [0, 0, 0.0, 0.0, {}]
+        # the total time of recursive calls is already in the
+        # outermost one
+        self.active[key] -= 1
+        primitive = self.active[key] == 0
+        entry[1] += 1
+        entry[2] += own
+        if primitive:
+            entry[0] += 1
+            entry[3] += total
+        if caller is not None:
+            c = entry[4].get(caller)
+            if c is None:
+                c = entry[4][caller] = [0, 0, 0.0, 0.0]
+            c[0] += 1
+            c[2] += own
+            if primitive:
+                c[1] += 1
+                c[3] += total
+
+    def operator(self, name, f):
+        # f, an eval_ function, timed as the operator name
+        key = ('~', 0, name)
+        enter = self.enter
+        leave = self.leave
+        def timed(stack):
+            enter(key)
+            f(stack)
+            leave()
+        return timed
+
+    def surface(self, key, f):
+        # a compiled surface function, timed as the closure key
+        enter = self.enter
+        leave = self.leave
+        def timed(face, u, v):
+            enter(key)
+            res = f(face, u, v)
+            leave()
+            return res
+        timed.uses_uv = f.uses_uv
+        return timed
+
+    def stop(self):
+        # ends the entries left running by a runtime error
+        while self.running:
+            self.leave()
+
+    def create_stats(self):
+        # makes the profiler readable by pstats.Stats
+        self.stop()
+        self.stats = {}
+        for key, (cc, nc, tt, ct, callers) in self.entries.items():
+            self.stats[key] = (cc, nc, tt, ct,
+                               dict((c, tuple(v)) for c, v in callers.items()))
+
+    def dump_stats(self, filename):
+        self.create_stats()
+        f = open(filename, 'wb')
+        try:
+            marshal.dump(self.stats, f)
+        finally:
+            f.close()
+
+    def report(self, limit=30):
+        # the entries that took the most time of their own, as text
+        self.stop()
+        entries = sorted(self.entries.items(), key=lambda e: -e[1][2])
+        lines = ["%10s %10s %10s  %s" % ("calls", "own", "total", "entry")]
+        for (filename, n, name), (cc, nc, tt, ct, callers) in entries[:limit]:
+            if filename == '~':
+                where = name
+            else:
+                where = "%s:%d(%s)" % (filename, n, name)
+            if cc != nc:
+                calls = "%d/%d" % (nc, cc)
+            else:
+                calls = "%d" % nc
+            lines.append("%10s %10.3f %10.3f  %s" % (calls, tt, ct, where))
+        return "\n".join(lines)
+
+if __name__=="__main__":
+    import os
+    import pstats
+
+    def test(a, b):
+        if a != b:
+            print "FAIL", a, b
+
+    now = [0.0]
+    timer = lambda: now[0]
+    def tick(t):
+        now[0] += t
+
+    from tokenizer import tokenize, generate_tokens
+    from parser import parse
+    from partialeval import fold
+    ast = parse(generate_tokens("{ /x x x mulf } /sq\n{ 1 2 addi } { 1 2 addi }\n"
+                                "2.0 sq apply", 3))
+    p = Profiler("test.gml")
+    p.scan(ast)
+    test(p.key(ast), ("test.gml", 0, "<program>"))
+    test(p.key(ast[0][1]), ("test.gml", 3, "/sq"))
+    test(p.key(ast[2][1]), ("test.gml", 4, "{ 1 2 addi }"))
+    test(p.key(ast[3][1]), ("test.gml", 4, "{ 1 2 addi }@14"))
+    folded = fold(ast)
+    test(p.key(folded[2][1]), ("test.gml", 4, "{ 3 }"))
+    unplaced = parse(tokenize("{ 1 } { 1 }"))
+    test(p.key(unplaced[0][1]), ("test.gml", 0, "{ 1 }"))
+    test(p.key(unplaced[1][1]) != p.key(unplaced[0][1]), True)
+
+    sq = p.key(ast[0][1])
+    mulf = p.operator('mulf', lambda stack: tick(1.0))
+    p.enter(p.key(ast))
+    tick(0.5)
+    p.enter(sq)
+    mulf([])
+    p.enter(sq)
+    tick(2.0)
+    p.leave()
+    p.leave()
+    p.create_stats()
+    test(p.stats[('~', 0, 'mulf')], (1, 1, 1.0, 1.0, {sq: (1, 1, 1.0, 1.0)}))
+    test(p.stats[sq][:4], (1, 2, 2.0, 3.0))
+    test(p.stats[p.key(ast)], (1, 1, 0.5, 3.5, {}))
+
+    p.dump_stats("test.prof")
+    s = pstats.Stats("test.prof")
+    test(s.total_calls, 4)
+    os.remove("test.prof")
+    test(p.report().splitlines()[1].split(), ['2/1', '2.000', '3.000', 'test.gml:3(/sq)'])
@@ -0,0 +1,175 @@
+import marshal
+import surfacecompiler
+
+# Memoization of pure GML code, when evaluator.memo_size is set. Code
+# is pure when it only runs the numeric operators of the surface
+# compiler on literals, the names it binds itself and the values it
+# pops, with applies and ifs only of the literal closures the
+# evaluator inlines. Its results then only depend on the values it
+# pops, so they are cached per code, keyed on those values. Caches that
+# rarely hit turn themselves off.
+
+literals = ['Integer', 'Real', 'Boolean', 'String', 'Point']
+
+# code with fewer operators is faster to run than to look up
+min_ops = 4
+
+# A cache that has had fewer than one hit in min_rate lookups after
+# probe of them costs more than it saves, and is turned off
+probe = 256
+min_rate = 4
+
+def effect(ast):
+    # The number of values pure code ast pops from the stack it starts
+    # with, and the number it leaves in their place, or None if ast
+    # isn't pure, or not worth caching
+    r = body_effect(ast, set(), 0, 0, 0)
+    if r is None:
+        return None
+    depth, low, nops = r
+    if nops < min_ops:
+        return None
+    return -low, depth - low
+
+def body_effect(ast, names, depth, low, nops):
+    # depth is the height of the stack relative to the start, and low
+    # the lowest it has been
+    i = 0
+    n = len(ast)
+    while i < n:
+        t, v = ast[i]
+        i += 1
+        if t in literals:
+            depth += 1
+        elif t == 'Binder':
+            depth -= 1
+            low = min(low, depth)
+            names = names | set([v])
+        elif t == 'Identifier':
+            if v not in names:
+                return None
+            depth += 1
+        elif t == 'Function':
+            if ast[i:i + 1] == [('Operator', 'apply')]:
+                r = body_effect(v, names, depth, low, nops)
+                if r is None:
+                    return None
+                depth, low, nops = r
+                i += 1
+            elif i + 1 < n and ast[i][0] == 'Function' and \
+                 ast[i + 1] == ('Operator', 'if'):
+                depth -= 1
+                low = min(low, depth)
+                r1 = body_effect(v, names, depth, low, nops)
+                r2 = body_effect(ast[i][1], names, depth, low, nops)
+                if r1 is None or r2 is None or r1[0] != r2[0]:
+                    return None
+                depth = r1[0]
+                low = min(r1[1], r2[1])
+                nops = max(r1[2], r2[2])
+                i += 2
+            else:
+                return None
+        elif t == 'Operator' and v in surfacecompiler.operators:
+            depth -= len(surfacecompiler.operators[v][0])
+            low = min(low, depth)
+            depth += 1
+            nops += 1
+        else:
+            return None
+    return depth, low, nops
+
+def key(args):
+    # marshal keeps the types, so 1, 1.0 and true are different keys,
+    # and the bits of floats, so 0.0 and -0.0 are too
+    return marshal.dumps(args)
+
+class LRUCache(object):
+    # The results of one piece of pure code, for the size most recently
+    # used arguments. The entries are in a circular doubly linked list
+    # of [previous, next, key, value], oldest first after the root.
+    def __init__(self, size, nargs, nresults):
+        self.size = size
+        self.nargs = nargs
+        self.nresults = nresults
+        self.hits = 0
+        self.misses = 0
+        self.active = True
+        self.table = {}
+        root = []
+        root[:] = [root, root, None, None]
+        self.root = root
+
+    def get(self, key):
+        link = self.table.get(key)
+        if link is None:
+            self.misses += 1
+            if self.misses >= probe and self.hits * min_rate < self.misses:
+                self.active = False
+            return None
+        self.hits += 1
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return link[3]
+
+    def put(self, key, value):
+        if key in self.table:
+            return
+        root = self.root
+        if len(self.table) >= self.size:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.table[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self.table[key] = link
+
+if __name__=="__main__":
+    from tokenizer import tokenize
+    from parser import parse
+
+    def test(a, b):
+        if a != b:
+            print "FAIL", a, b
+
+    def gml(s):
+        return parse(tokenize(s))
+
+    test(effect(gml("real 25173.0 mulf 13849.0 addf 65536.0 divf frac 65536.0 mulf floor")), (1, 1))
+    test(effect(gml("/y /x x x mulf y y mulf addf sqrt")), (2, 1))
+    test(effect(gml("/x x 0.0 lessf { x negf } { x } if 2.0 mulf 1.0 addf sqrt")), (1, 1))
+    test(effect(gml("/x x 0.0 lessf { x negf } { } if 2.0 mulf 1.0 addf")), None)
+    test(effect(gml("/x x y mulf 2.0 mulf 1.0 addf sqrt")), None)
+    test(effect(gml("/x x x mulf sphere")), None)
+    test(effect(gml("/x x f apply")), None)
+    test(effect(gml("/x x x mulf")), None)
+    test(effect(gml("/b /a a b a b point getx getz sqrt")), (2, 2))
+
+    test(key((1,)) != key((1.0,)), True)
+    test(key((1,)) != key((True,)), True)
+    test(key((0.0,)) != key((-0.0,)), True)
+
+    c = LRUCache(2, 1, 1)
+    c.put(key((1,)), [1])
+    c.put(key((2,)), [4])
+    test(c.get(key((1,))), [1])
+    c.put(key((3,)), [9])
+    test(c.get(key((2,))), None)
+    test(c.get(key((1,))), [1])
+    test(c.get(key((3,))), [9])
+    test(len(c.table), 2)
+    test((c.hits, c.misses), (3, 1))
+
+    c = LRUCache(2, 1, 1)
+    for i in range(probe):
+        test(c.active, True)
+        c.get(key((i,)))
+    test(c.active, False)
@@ -1,41 +1,74 @@
 class GMLSyntaxError(Exception):
     pass
 
-def do_parse(tokenlist):
+# The closing token of each kind of literal, and its node
+closers = {'BeginFunction': ('EndFunction', 'Function'),
+           'BeginArray': ('EndArray', 'Array')}
+
+class Body(list):
+    # the nodes of a function or array literal, and the position of its
+    # opening token, if the tokens have positions
+    position = None
+
+def body_like(body):
+    # an empty Body at the position of body
+    new = Body()
+    new.position = getattr(body, 'position', None)
+    return new
+
+def encode(node):
+    # node, with the positions of its literals, as values marshal saves
+    t, v = node
+    if t == 'Function' or t == 'Array':
+        return (t, [encode(n) for n in v], getattr(v, 'position', None))
+    return node
+
+def decode(node):
+    if len(node) > 2:
+        t, v, position = node
+        body = Body([decode(n) for n in v])
+        body.position = position
+        return (t, body)
+    return node
+
+def where(t):
+    # the source position of token t, if the tokenizer gave it one, as
+    # (line, column), or (line, column, file) from the preprocessor
+    if len(t) > 2:
+        if len(t[2]) > 2:
+            return " at line %d, column %d of %s" % t[2]
+        return " at line %d, column %d" % t[2]
+    return ""
+
+def parse(tokens):
+    # Parses an iterable of tokens, as (name, value) or (name, value,
+    # position), in one pass. The literals being parsed are on a stack
+    # of (closer, node, outer body, opening token).
     ast = []
-    if len(tokenlist) == 0:
-        raise GMLSyntaxError
-    while tokenlist:
-        t = tokenlist[0]
-        if t[0] in ['EndFunction', 'EndArray']:
-            return tokenlist, ast
-        tokenlist.pop(0)
-        if t[0] == 'BeginFunction':
-            tokenlist, tmp = do_parse(tokenlist)
-            try:
-                e = tokenlist.pop(0)
-            except IndexError:
-                raise GMLSyntaxError
-            if e[0] != 'EndFunction':
-                raise GMLSyntaxError
-            ast.append(('Function', tmp))
-        elif t[0] == 'BeginArray':
-            tokenlist, tmp = do_parse(tokenlist)            
-            try:
-                e = tokenlist.pop(0)
-            except IndexError:
-                raise GMLSyntaxError
-            if e[0] != 'EndArray':
-                raise GMLSyntaxError
-            ast.append(('Array', tmp))
+    stack = []
+    t = None
+    for t in tokens:
+        name = t[0]
+        if name in closers:
+            closer, node = closers[name]
+            stack.append((closer, node, ast, t))
+            ast = Body()
+            if len(t) > 2:
+                ast.position = t[2]
+        elif name == 'EndFunction' or name == 'EndArray':
+            if not stack:
+                raise GMLSyntaxError, "unexpected " + name + where(t)
+            closer, node, outer, start = stack.pop()
+            if name != closer:
+                raise GMLSyntaxError, "unexpected " + name + where(t)
+            outer.append((node, ast))
+            ast = outer
         else:
-            ast.append(t)
-    return tokenlist, ast
-
-def parse(tokenlist):
-    tokenlist, ast = do_parse(tokenlist)
-    if tokenlist:
-        raise GMLSyntaxError
+            ast.append(t[:2])
+    if t is None:
+        raise GMLSyntaxError, "empty program"
+    if stack:
+        raise GMLSyntaxError, "unclosed " + stack[-1][1] + where(stack[-1][3])
     return ast
 
 def test(tokenlist, res):
@@ -51,8 +84,7 @@ def test(tokenlist, res):
             raise    
 
 if __name__=="__main__":
-    from preprocess import preprocess
-    from tokenizer import tokenize
+    from preprocess import preprocess_tokens
     import sys
     
     if len(sys.argv) > 1:
@@ -60,7 +92,7 @@ if __name__=="__main__":
             print f
             print "=" * len(f)
             try:
-                ast = parse(tokenize(preprocess(f)))
+                ast = parse(preprocess_tokens(f))
                 print ast
             except GMLSyntaxError:
                 print "contains syntax errors"
@@ -99,3 +131,28 @@ if __name__=="__main__":
           ('EndFunction', None)],
          [('Function', [('Integer', 1), ('Array', [('Integer', 2), ('Integer', 3)])])])
     
+    test([('BeginFunction', None), ('EndFunction', None)], [('Function', [])])
+    test(iter([('Integer', 1, (1, 1)), ('BeginArray', None, (1, 3)),
+               ('EndArray', None, (2, 1))]),
+         [('Integer', 1), ('Array', [])])
+    try:
+        parse([('Integer', 1, (1, 1)), ('BeginArray', None, (1, 3))])
+    except GMLSyntaxError, e:
+        if str(e) != "unclosed Array at line 1, column 3":
+            print "unclosed Array ==", e
+
+    # literals keep the position of their opening token
+    ast = parse([('BeginFunction', None, (2, 5, 'a.gml')),
+                 ('BeginArray', None, (3, 1, 'a.gml')), ('EndArray', None, (3, 3, 'a.gml')),
+                 ('EndFunction', None, (4, 1, 'a.gml'))])
+    if ast[0][1].position != (2, 5, 'a.gml') or ast[0][1][0][1].position != (3, 1, 'a.gml'):
+        print "positions ==", ast
+    import marshal
+    saved = decode(marshal.loads(marshal.dumps(encode(ast[0]))))
+    if saved != ast[0] or saved[1][0][1].position != (3, 1, 'a.gml'):
+        print "decode(encode(...)) ==", saved
+    try:
+        parse([('EndArray', None, (1, 2, 'a.gml'))])
+    except GMLSyntaxError, e:
+        if str(e) != "unexpected EndArray at line 1, column 2 of a.gml":
+            print "unexpected EndArray ==", e
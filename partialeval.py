@@ -0,0 +1,222 @@
+import surfacecompiler
+from parser import body_like
+
+# Simplifies the parse tree of a GML program before it is compiled.
+# Operators whose operands are all literals are replaced by their
+# result, and names bound to a literal, or to a closure that uses no
+# names from outside it, are replaced by it where that binding is the
+# one they see. An applied literal closure is spliced into its caller
+# when the values of its binders are literals, which are then inlined
+# too, and an if with a literal predicate becomes an apply of the
+# branch it takes. Points have no literal syntax, so a folded point is
+# a new ('Point', (x, y, z)) node. Operators that would fail, or give
+# an infinity or a nan, are left for the evaluator, so the program
+# fails in the same way it did.
+
+literals = ['Integer', 'Real', 'Boolean', 'String', 'Point']
+
+# operator: (operand types, result type, Python function), with the
+# same semantics as the compiled surfaces
+operators = {}
+for name, (argtypes, restype, expr) in surfacecompiler.operators.items():
+    params = tuple(["a%d" % i for i in range(len(argtypes))])
+    f = eval("lambda %s: %s" % (", ".join(params), expr % params),
+             surfacecompiler.runtime)
+    operators[name] = (argtypes, restype, f)
+
+# limits for splicing closures, a closure that applies itself from
+# the stack would be spliced forever
+max_depth = 64
+max_steps = 100000
+
+def finite(value):
+    if type(value) is float:
+        return value == value and value not in [float('inf'), float('-inf')]
+    if type(value) is tuple:
+        return all(finite(c) for c in value)
+    return True
+
+def closed(ast, bound=()):
+    # whether ast only uses the names it binds itself
+    bound = set(bound)
+    for t, v in ast:
+        if t == 'Binder':
+            bound.add(v)
+        elif t == 'Identifier' and v not in bound:
+            return False
+        elif t in ['Function', 'Array'] and not closed(v, bound):
+            return False
+    return True
+
+def constant(node):
+    return node[0] in literals or (node[0] == 'Function' and closed(node[1]))
+
+def fold_operator(name, out):
+    argtypes, restype, f = operators[name]
+    n = len(argtypes)
+    if len(out) < n:
+        return False
+    args = out[len(out) - n:]
+    if [t for t, v in args] != list(argtypes):
+        return False
+    try:
+        value = f(*[v for t, v in args])
+    except (ArithmeticError, ValueError):
+        return False
+    if not finite(value):
+        return False
+    out[len(out) - n:] = [(restype, value)]
+    return True
+
+class Folder(object):
+    def __init__(self):
+        self.depth = 0
+        self.steps = 0
+
+    def apply(self, body, out):
+        # The code for applying a literal closure with body, which is
+        # already folded. Only closed bodies are spliced: a free name
+        # in body is bound where the closure was made, and the binders
+        # dropped since then would make it see other bindings at the
+        # call site.
+        if self.depth < max_depth and self.steps < max_steps and closed(body):
+            saved = out[:]
+            self.depth += 1
+            spliced = self.fold_body(body, {}, out, True)
+            self.depth -= 1
+            if spliced:
+                return
+            out[:] = saved
+        out.append(('Function', body))
+        out.append(('Operator', 'apply'))
+
+    def fold_body(self, ast, consts, out, spliced=False):
+        # Appends the simplified ast to out, consts maps the names
+        # bound to constants to their node. If spliced, the binders
+        # of ast are dropped, and it fails, returning False, when one
+        # of them doesn't get a literal.
+        for node in ast:
+            t, v = node
+            if spliced:
+                self.steps += 1
+            if t == 'Binder':
+                if spliced:
+                    if not out or out[-1][0] not in literals:
+                        return False
+                    consts[v] = out.pop()
+                    continue
+                if out and constant(out[-1]):
+                    consts[v] = out[-1]
+                else:
+                    consts.pop(v, None)
+                out.append(node)
+            elif t == 'Identifier':
+                out.append(consts.get(v, node))
+            elif t == 'Function':
+                out.append(('Function', self.fold_body(v, dict(consts), body_like(v))))
+            elif t == 'Array':
+                out.append(('Array', self.fold_body(v, dict(consts), body_like(v))))
+            elif t == 'Operator' and v == 'apply' and \
+                 out and out[-1][0] == 'Function':
+                self.apply(out.pop()[1], out)
+            elif t == 'Operator' and v == 'if' and len(out) >= 3 and \
+                 out[-3][0] == 'Boolean' and out[-2][0] == 'Function' and \
+                 out[-1][0] == 'Function':
+                c2 = out.pop()[1]
+                c1 = out.pop()[1]
+                if out.pop()[1]:
+                    self.apply(c1, out)
+                else:
+                    self.apply(c2, out)
+            elif t == 'Operator' and v in operators:
+                if not fold_operator(v, out):
+                    out.append(node)
+            else:
+                out.append(node)
+        if spliced:
+            return True
+        return out
+
+def fold(ast, consts={}):
+    # consts are the constants bound by code run before ast
+    return Folder().fold_body(ast, dict(consts), [])
+
+if __name__=="__main__":
+    from tokenizer import tokenize
+    from parser import parse
+
+    def test(gml, res):
+        t = fold(parse(tokenize(gml)))
+        if t != res:
+            print gml, "!=", res
+            print gml, "==", t
+
+    test("1 2 addi", [('Integer', 3)])
+    test("360.0 30.0 divf", [('Real', 12.0)])
+    test("1.0 2.0 addf 3.0 point", [('Real', 3.0), ('Real', 3.0),
+                                   ('Operator', 'point')])
+    test("1.0 2.0 3.0 point", [('Point', (1.0, 2.0, 3.0))])
+    test("1.0 2.0 3.0 point getz 90.0 sin", [('Real', 3.0), ('Real', 1.0)])
+    test("1 0 divi", [('Integer', 1), ('Integer', 0), ('Operator', 'divi')])
+    test("-1.0 sqrt", [('Real', -1.0), ('Operator', 'sqrt')])
+    test("1 2.0 addi", [('Integer', 1), ('Real', 2.0), ('Operator', 'addi')])
+    test("1e200 1e200 mulf", [('Real', 1e200), ('Real', 1e200),
+                              ('Operator', 'mulf')])
+    test("0.5 /x x x mulf", [('Real', 0.5), ('Binder', 'x'), ('Real', 0.25)])
+    test("u /x x", [('Identifier', 'u'), ('Binder', 'x'), ('Identifier', 'x')])
+    test("1 /x { x } /f 2 /x f apply",
+         [('Integer', 1), ('Binder', 'x'), ('Function', [('Integer', 1)]),
+          ('Binder', 'f'), ('Integer', 2), ('Binder', 'x'), ('Integer', 1)])
+    test("1 /x { /x x } /f", [('Integer', 1), ('Binder', 'x'),
+                              ('Function', [('Binder', 'x'), ('Identifier', 'x')]),
+                              ('Binder', 'f')])
+    test("1 2 lessi { 1.0 } { 2.0 } if 2.0 mulf", [('Real', 2.0)])
+    test("u false { 1 } { /x x } if",
+         [('Identifier', 'u'),
+          ('Function', [('Binder', 'x'), ('Identifier', 'x')]),
+          ('Operator', 'apply')])
+    test("b { 1 } { 2 } if", [('Identifier', 'b'), ('Function', [('Integer', 1)]),
+                              ('Function', [('Integer', 2)]), ('Operator', 'if')])
+    test("2.0 { 3.0 mulf } apply", [('Real', 6.0)])
+    test("{ /b /a a b point } /p 1.0 2.0 3.0 p apply",
+         [('Function', [('Binder', 'b'), ('Binder', 'a'), ('Identifier', 'a'),
+                        ('Identifier', 'b'), ('Operator', 'point')]),
+          ('Binder', 'p'), ('Point', (1.0, 2.0, 3.0))])
+    test("{ 1.0 255.0 divf /s { /b s b real mulf } } apply /rgb 255 rgb apply",
+         [('Function', [('Binder', 'b'), ('Real', 1.0 / 255.0),
+                        ('Identifier', 'b'), ('Operator', 'real'),
+                        ('Operator', 'mulf')]),
+          ('Binder', 'rgb'), ('Real', 1.0)])
+    test("{ /self /n n self self apply } /f 1 f f apply",
+         [('Function', [('Binder', 'self'), ('Binder', 'n'), ('Identifier', 'n'),
+                        ('Identifier', 'self'), ('Identifier', 'self'),
+                        ('Operator', 'apply')]),
+          ('Binder', 'f'), ('Integer', 1),
+          ('Function', [('Binder', 'self'), ('Binder', 'n'), ('Identifier', 'n'),
+                        ('Identifier', 'self'), ('Identifier', 'self'),
+                        ('Operator', 'apply')]),
+          ('Function', [('Binder', 'self'), ('Binder', 'n'), ('Identifier', 'n'),
+                        ('Identifier', 'self'), ('Identifier', 'self'),
+                        ('Operator', 'apply')]),
+          ('Operator', 'apply')])
+    test("{ apply } /y y y apply", [('Function', [('Operator', 'apply')]),
+                                    ('Binder', 'y'), ('Operator', 'apply')])
+    # the free names of a closure keep the bindings it was made with
+    test("[ 5 ] 0 get /x { { x } 7 /x apply } apply",
+         [('Array', [('Integer', 5)]), ('Integer', 0), ('Operator', 'get'),
+          ('Binder', 'x'),
+          ('Function', [('Function', [('Identifier', 'x')]), ('Integer', 7),
+                        ('Binder', 'x'), ('Operator', 'apply')]),
+          ('Operator', 'apply')])
+    test("u /x 1 { { x } 7 /x apply } apply",
+         [('Identifier', 'u'), ('Binder', 'x'), ('Integer', 1),
+          ('Function', [('Function', [('Identifier', 'x')]), ('Integer', 7),
+                        ('Binder', 'x'), ('Operator', 'apply')]),
+          ('Operator', 'apply')])
+    test("2 { /y { y } 7 /y apply } apply", [('Integer', 2)])
+    test("u /x true { x } { 0 } 7 /x if",
+         [('Identifier', 'u'), ('Binder', 'x'), ('Boolean', True),
+          ('Function', [('Identifier', 'x')]), ('Function', [('Integer', 0)]),
+          ('Integer', 7), ('Binder', 'x'), ('Operator', 'if')])
+    test("[ 1 2 addi ] 0 get", [('Array', [('Integer', 3)]), ('Integer', 0),
+                                ('Operator', 'get')])
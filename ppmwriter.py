@@ -1,14 +1,104 @@
+import os
+try:
+    import numpy
+except ImportError:
+    # only needed to pack pixels in bulk
+    numpy = None
+
+def pack_pixels(pixels):
+    # Clamps and scales a list of (r, g, b) pixels to a string of bytes
+    if numpy is not None and pixels:
+        a = numpy.array(pixels, dtype=numpy.float64)
+        numpy.clip(a, 0.0, 1.0, out=a)
+        a *= 255.0
+        return a.astype(numpy.uint8).tostring()
+    return str(bytearray([int(255.0 * min(max(c, 0.0), 1.0))
+                          for p in pixels for c in p]))
+
+class PPMWriter(object):
+    # Writes an image as it is rendered, either in whole rows or in
+    # tiles arriving in any order.  Rows are written out as soon as
+    # they and all rows above them are complete, so only the rows of
+    # unfinished tiles are held in memory.
+    def __init__(self, filename, w, h):
+        self.w = w
+        self.h = h
+        self.y = 0
+        self.pending = {}
+        self.f = open(filename, 'wb')
+        self.f.write("P6 %s %s 255\n"%(w, h))
+
+    def write_rows(self, data):
+        if self.pending:
+            raise ValueError("rows written while tiles are pending")
+        self.f.write(data)
+        self.y += len(data) // (3 * self.w)
+
+    def write_tile(self, x0, y0, x1, y1, data):
+        tw = 3 * (x1 - x0)
+        for y in range(y0, y1):
+            row = self.pending.get(y)
+            if row is None:
+                row = self.pending[y] = [bytearray(3 * self.w), 0]
+            i = (y - y0) * tw
+            row[0][3 * x0:3 * x1] = data[i:i + tw]
+            row[1] += x1 - x0
+        self.flush()
+
+    def flush(self):
+        rows = []
+        while self.y in self.pending and self.pending[self.y][1] == self.w:
+            rows.append(self.pending.pop(self.y)[0])
+            self.y += 1
+        if rows:
+            self.f.write(''.join(map(str, rows)))
+
+    def close(self):
+        self.f.close()
+
+    def abort(self):
+        # a failed render leaves no partial image behind
+        self.f.close()
+        os.remove(self.f.name)
+
 def write_ppm(pixels, w, h, filename):
-    f = open(filename, 'wb')
-    f.write("P6 %s %s 255\n"%(w, h))
-    for r, g, b in pixels:
-        f.write(chr(int(255.0 * min(max(r, 0.0), 1.0))))
-        f.write(chr(int(255.0 * min(max(g, 0.0), 1.0))))
-        f.write(chr(int(255.0 * min(max(b, 0.0), 1.0))))
+    f = PPMWriter(filename, w, h)
+    try:
+        f.write_rows(pack_pixels(pixels))
+    finally:
+        f.close()
 
 if __name__=="__main__":
+    def test(a, b):
+        if a != b:
+            print "FAIL", a, b
+
     pixels = []
     for y in range(256):
         for x in range(256):
             pixels.append((x/255.0, y/255.0, (x+y)/(2.0*255.0)))
     write_ppm(pixels, 256, 256, "test.ppm")
+
+    # bulk packing matches clamping each component on its own
+    odd = [(-1.0, 0.5, 2.0), (1.0, 0.0, 0.999), (0.1, 0.2, 0.3)]
+    expected = ''.join(chr(int(255.0 * min(max(c, 0.0), 1.0)))
+                       for p in odd for c in p)
+    test(pack_pixels(odd), expected)
+    saved, numpy = numpy, None
+    test(pack_pixels(odd), expected)
+    numpy = saved
+
+    # tiles in any order give the same file as whole rows
+    data = open("test.ppm", 'rb').read()
+    f = PPMWriter("test2.ppm", 256, 256)
+    tiles = [(x0, y0, min(x0 + 48, 256), min(y0 + 48, 256))
+             for y0 in range(0, 256, 48) for x0 in range(0, 256, 48)]
+    for x0, y0, x1, y1 in reversed(tiles):
+        tpixels = [pixels[y * 256 + x] for y in range(y0, y1)
+                   for x in range(x0, x1)]
+        f.write_tile(x0, y0, x1, y1, pack_pixels(tpixels))
+    test(len(f.pending), 0)
+    test(f.y, 256)
+    f.close()
+    test(open("test2.ppm", 'rb').read(), data)
+    os.remove("test2.ppm")
@@ -1,11 +1,350 @@
 #!/bin/python
-import subprocess
+import hashlib
+import marshal
+import os
+import re
+import sys
+import tokenizer
+
+# The C preprocessor as the GML files use it: /* */ and // comments,
+# #include "file", and #define, #undef, #ifdef, #ifndef, #else and
+# #endif for include guards. Macros with bodies, and the other
+# directives, are errors, and defined names are not replaced in the
+# text. Files are read and split once, and kept while their mtime and
+# size stay the same, with each run of text between directives
+# tokenized the first time it is used. preprocess_tokens feeds those
+# tokens to the parser without making the text of the whole program.
+
+class PreprocessError(Exception):
+    pass
+
+# gcc's limit
+max_include_depth = 200
+
+# comments, and the strings they can't start in
+comment = re.compile(r'"(?:[^"\\\n]|\\.)*"|/\*.*?\*/|//[^\n]*', re.S)
+directive = re.compile(r"^[ \t]*#[ \t]*(\w*)[ \t]*(.*?)[ \t\r]*$", re.M)
+include = re.compile(r'^"([^"]+)"$')
+name = re.compile(r"^[a-zA-Z_]\w*$")
+
+def uncomment(m):
+    # a comment is blanked out, keeping its newlines, so lines and
+    # columns still count
+    s = m.group()
+    if s[0] == '"':
+        return s
+    return re.sub(r"[^\n]", " ", s)
+
+class Chunk(object):
+    # a run of text between directives of the file at path, starting on
+    # line
+    __slots__ = ['text', 'line', 'path', 'tokens', 'complete']
+
+    def __init__(self, text, line, path):
+        self.text = text
+        self.line = line
+        self.path = path
+        self.tokens = None
+        self.complete = True
+
+    def get_tokens(self):
+        if self.tokens is None:
+            tokens = []
+            try:
+                for name, value, (line, column) in \
+                        tokenizer.generate_tokens(self.text, self.line, True):
+                    tokens.append((name, value, (line, column, self.path)))
+            except tokenizer.UnexpectedCharacter:
+                self.complete = False
+            self.tokens = tokens
+        return self.tokens
+
+# path: (mtime, size, pieces), the pieces are Chunks and
+# (directive, argument, line)
+cache = {}
+
+# The directory the split and tokenized files are also saved in, like
+# .pyc files, for later runs, or None. They are named after the sha1
+# of their path and their name with a c added (...-house.gmlc), and
+# keyed on the sha1 of the path and contents of the file, which the
+# positions of the tokens name, and on version, which changes with
+# the tokens and with Python's marshal format.
+disk_cache = None
+cache_format = 2
+version = hashlib.sha1(repr((cache_format, sys.version,
+                             [(regexp, tokenname) for regexp, tokenname,
+                              emit, evaluator in tokenizer.tokens],
+                             sorted(tokenizer.operators)))).hexdigest()
+
+def split(text, path):
+    if not text.endswith("\n"):
+        text += "\n"
+    text = comment.sub(uncomment, text)
+    pieces = []
+    pos = 0
+    line = 1
+    for m in directive.finditer(text):
+        chunk = text[pos:m.start()]
+        if chunk.strip():
+            pieces.append(Chunk(chunk, line, path))
+        line += chunk.count("\n")
+        pieces.append((m.group(1), m.group(2), line))
+        pos = m.end()
+    if text[pos:].strip():
+        pieces.append(Chunk(text[pos:], line, path))
+    return pieces
+
+def read_cache(name, header):
+    # the value saved as name in disk_cache with header, or None
+    try:
+        f = open(os.path.join(disk_cache, name), "rb")
+        try:
+            if f.readline() != header:
+                return None
+            return marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def write_cache(name, header, value):
+    # Saves value as name in disk_cache, after header. It is written
+    # to a new file and renamed, so a run reading it at the same time
+    # sees either all of it or the old one.
+    path = os.path.join(disk_cache, name)
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        if not os.path.isdir(disk_cache):
+            os.makedirs(disk_cache)
+        f = open(tmp, "wb")
+        try:
+            f.write(header)
+            marshal.dump(value, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def compiled_name(path):
+    return "%s-%sc" % (hashlib.sha1(path).hexdigest()[:16], os.path.basename(path))
+
+def load_compiled(path, digest):
+    # the pieces saved for the file at path with digest, or None
+    saved = read_cache(compiled_name(path), "%s %s\n" % (version, digest))
+    if saved is None:
+        return None
+    pieces = []
+    for piece in saved:
+        if piece[0] is None:
+            chunk = Chunk(piece[1], piece[2], path)
+            chunk.tokens, chunk.complete = piece[3:]
+            pieces.append(chunk)
+        else:
+            pieces.append(piece)
+    return pieces
+
+def save_compiled(path, digest, pieces):
+    # Tokenizes all the text of the file at path and saves its pieces.
+    # Text with errors is saved untokenized, so that they are raised
+    # if it is used.
+    saved = []
+    for piece in pieces:
+        if isinstance(piece, Chunk):
+            try:
+                piece.get_tokens()
+            except tokenizer.EvaluationError:
+                pass
+            saved.append((None, piece.text, piece.line,
+                          piece.tokens, piece.complete))
+        else:
+            saved.append(piece)
+    write_cache(compiled_name(path), "%s %s\n" % (version, digest), saved)
+
+def load(path):
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        raise PreprocessError, "%s: %s" % (path, e.strerror)
+    entry = cache.get(path)
+    if entry is not None and entry[:2] == (st.st_mtime, st.st_size):
+        return entry[2]
+    f = open(path)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+    pieces = None
+    if disk_cache is not None:
+        digest = hashlib.sha1(path + "\n" + text).hexdigest()
+        pieces = load_compiled(path, digest)
+    if pieces is None:
+        pieces = split(text, intern(path))
+        if disk_cache is not None:
+            save_compiled(path, digest, pieces)
+    cache[path] = (st.st_mtime, st.st_size, pieces)
+    return pieces
+
+def chunks(path, defines, depth=0):
+    # Yields the Chunks of the file at path that aren't left out by
+    # conditionals, with its includes. defines is the set of defined
+    # names.
+    if depth > max_include_depth:
+        raise PreprocessError, "%s: #include nested too deeply" % path
+    # for each conditional, whether its parent is active and whether
+    # a branch has been taken
+    conditionals = []
+    active = True
+    for piece in load(path):
+        if isinstance(piece, Chunk):
+            if active:
+                yield piece
+            continue
+        d, arg, line = piece
+        where = "%s:%d" % (path, line)
+        if d in ['ifdef', 'ifndef']:
+            if not name.match(arg):
+                raise PreprocessError, "%s: bad #%s" % (where, d)
+            taken = (arg in defines) == (d == 'ifdef')
+            conditionals.append((active, taken))
+            active = active and taken
+        elif d == 'else':
+            if not conditionals:
+                raise PreprocessError, "%s: #else without #if" % where
+            outer, taken = conditionals[-1]
+            conditionals[-1] = (outer, True)
+            active = outer and not taken
+        elif d == 'endif':
+            if not conditionals:
+                raise PreprocessError, "%s: #endif without #if" % where
+            active = conditionals.pop()[0]
+        elif not active:
+            pass
+        elif d == 'include':
+            m = include.match(arg)
+            if not m:
+                raise PreprocessError, "%s: bad #include %s" % (where, arg)
+            included = os.path.join(os.path.dirname(path), m.group(1))
+            for chunk in chunks(included, defines, depth + 1):
+                yield chunk
+        elif d == 'define':
+            parts = arg.split(None, 1)
+            if not parts or not name.match(parts[0]):
+                raise PreprocessError, "%s: bad #define" % where
+            if len(parts) > 1:
+                raise PreprocessError, "%s: macro bodies are not supported" % where
+            defines.add(parts[0])
+        elif d == 'undef':
+            defines.discard(arg)
+        elif d:
+            raise PreprocessError, "%s: #%s is not supported" % (where, d)
+    if conditionals:
+        raise PreprocessError, "%s: unterminated conditional" % path
+
+def tokens(chunks):
+    # the tokens of chunks, as tokenizer.generate_tokens gives them
+    # with the file added to their positions, stopping at the first
+    # character no token starts with
+    for chunk in chunks:
+        for t in chunk.get_tokens():
+            yield t
+        if not chunk.complete:
+            return
+
+def preprocess_tokens(filename):
+    return tokens(chunks(os.path.abspath(filename), set()))
+
+def nonempty(chunks):
+    # the chunks that have tokens, or stop the tokens
+    for chunk in chunks:
+        if chunk.get_tokens() or not chunk.complete:
+            yield chunk
+
+def tokens_after(filename, prefix):
+    # The tokens of the preprocessed file after prefix, a list of the
+    # nonempty chunks it starts with, or None if it doesn't start with
+    # them
+    rest = nonempty(chunks(os.path.abspath(filename), set()))
+    for expected in prefix:
+        for chunk in rest:
+            break
+        else:
+            return None
+        if chunk is not expected:
+            return None
+    return tokens(rest)
 
 def preprocess(filename):
-    cmd = "gcc -E -x c -P %s"%filename
-    return subprocess.Popen(cmd.split(), stdout=subprocess.PIPE).stdout.read()
+    return "".join([chunk.text for chunk in
+                    chunks(os.path.abspath(filename), set())])
 
 if __name__=="__main__":
-    import sys
-    print preprocess(sys.argv[1])
-    
+    import tempfile
+    import shutil
+
+    if len(sys.argv) > 1:
+        print preprocess(sys.argv[1])
+        sys.exit(0)
+
+    def test(a, b):
+        if a != b:
+            print "FAIL", a, b
+
+    d = tempfile.mkdtemp()
+    disk_cache = os.path.join(d, "cache")
+    def write(name, text):
+        f = open(os.path.join(d, name), "w")
+        f.write(text)
+        f.close()
+        return os.path.join(d, name)
+
+    try:
+        a = write("a.ins", "#ifndef _A_\n#define _A_\n/* a */ { 1 }\n#endif\n")
+        main = write("main.gml", '#include "a.ins"\r\n#include "a.ins"\n'
+                     '/* two\n lines */ 2 % "/*"\n"x // y" 3\n')
+        test(list(preprocess_tokens(main)),
+             [('BeginFunction', None, (3, 9, a)), ('Integer', 1, (3, 11, a)),
+              ('EndFunction', None, (3, 13, a)), ('Integer', 2, (4, 11, main)),
+              ('String', 'x // y', (5, 1, main)), ('Integer', 3, (5, 10, main))])
+        test(preprocess(main).split(), ['{', '1', '}', '2', '%', '"/*"',
+                                        '"x', '//', 'y"', '3'])
+        # cached until the file changes
+        pieces = cache[main][2]
+        test(load(main) is pieces, True)
+        # and on disk, until its contents change
+        first = list(preprocess_tokens(main))
+        cache.clear()
+        test(list(preprocess_tokens(main)), first)
+        test(os.path.exists(main + "c"), False)
+        test(isinstance(load_compiled(main, hashlib.sha1(main + "\n" + open(main).read()).hexdigest()),
+                        list), True)
+        test(load_compiled(main, "0"), None)
+        f = open(os.path.join(disk_cache, compiled_name(main)), "r+b")
+        f.seek(-10, 2)
+        f.truncate()
+        f.close()
+        cache.clear()
+        test(list(preprocess_tokens(main)), first)
+        write("main.gml", '#include "a.ins"\n4 ? 5\n')
+        os.utime(main, (0, 0))
+        test([v for t, v, p in preprocess_tokens(main)], [None, 1, None, 4])
+
+        write("lib.gml", '#include "a.ins"\n')
+        prefix = list(nonempty(chunks(os.path.join(d, "lib.gml"), set())))
+        test(len(prefix), 1)
+        test([v for t, v, p in tokens_after(main, prefix)], [4])
+        test(tokens_after(write("other.gml", "4\n"), prefix), None)
+
+        for text in ['#include "b.ins"\n', '#ifdef X\n', '#endif\n',
+                     '#define X 1\n', '#if 1\n#endif\n', '#include <a.ins>\n']:
+            write("bad.gml", text)
+            try:
+                list(preprocess_tokens(os.path.join(d, "bad.gml")))
+                print text, "!= PreprocessError"
+            except PreprocessError:
+                pass
+    finally:
+        shutil.rmtree(d)
@@ -1,4 +1,9 @@
 import math
+try:
+    import numpy
+except ImportError:
+    # only needed for the packet intersection kernels
+    numpy = None
 from transform import Transform
 from vecmat import normalize, dot, neg, add, mul, length, sub
 import copy
@@ -57,42 +62,221 @@ class Intersection(object):
     normal = property(**normal())
 
 
-class Node(object):
-    def intersect(self, raypos, raydir):
-        return []
+def merge_bounds(b1, b2):
+    if b1 is None or b2 is None:
+        return None
+    (lo1, hi1), (lo2, hi2) = b1, b2
+    return ((min(lo1[0], lo2[0]), min(lo1[1], lo2[1]), min(lo1[2], lo2[2])),
+            (max(hi1[0], hi2[0]), max(hi1[1], hi2[1]), max(hi1[2], hi2[2])))
 
-class Operator(Node):
-    def __init__(self, obj1, obj2):
-        self.obj1 = obj1
-        self.obj2 = obj2
+def intersect_bounds(b1, b2):
+    if b1 is None:
+        return b2
+    if b2 is None:
+        return b1
+    (lo1, hi1), (lo2, hi2) = b1, b2
+    return ((max(lo1[0], lo2[0]), max(lo1[1], lo2[1]), max(lo1[2], lo2[2])),
+            (min(hi1[0], hi2[0]), min(hi1[1], hi2[1]), min(hi1[2], hi2[2])))
+
+def hit_box(lo, hi, raypos, raydir):
+    # slab test, returns the distances where the ray enters and
+    # leaves the box, or None if it misses
+    tnear = -1e300
+    tfar = 1e300
+    for i in range(3):
+        p = raypos[i]
+        d = raydir[i]
+        if d == 0.0:
+            if p < lo[i] or p > hi[i]:
+                return None
+            continue
+        t1 = (lo[i] - p) / d
+        t2 = (hi[i] - p) / d
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > tnear:
+            tnear = t1
+        if t2 < tfar:
+            tfar = t2
+        if tnear > tfar or tfar < 0.0:
+            return None
+    return tnear, tfar
+
+def inside_box(lo, hi, pos):
+    x, y, z = pos
+    return (lo[0] <= x <= hi[0] and lo[1] <= y <= hi[1] and
+            lo[2] <= z <= hi[2])
+
+def build_bvh(leaves):
+    # leaves and inner nodes are tuples (lo, hi, left, right, obj)
+    if not leaves:
+        return None
+    if len(leaves) == 1:
+        return leaves[0]
+    # split at the median of the box centers along the axis
+    # where they are most spread out
+    centers = [mul(add(leaf[0], leaf[1]), 0.5) for leaf in leaves]
+    extent = [max([c[i] for c in centers]) - min([c[i] for c in centers])
+              for i in range(3)]
+    axis = extent.index(max(extent))
+    order = sorted(range(len(leaves)), key=lambda k: centers[k][axis])
+    leaves = [leaves[k] for k in order]
+    mid = len(leaves) // 2
+    left = build_bvh(leaves[:mid])
+    right = build_bvh(leaves[mid:])
+    lo, hi = merge_bounds(left[:2], right[:2])
+    return (lo, hi, left, right, None)
+
+class Node(object):
+    # Nodes are shared by every reference to them, so they don't change
+    # once they are built: the transforms return a transformed copy,
+    # which shares the operands or the surface with the original.
+    def transformed(self):
+        obj = copy.copy(self)
+        obj.transform = self.transform.copy()
+        return obj
 
     def translate(self, tx, ty, tz):
-        self.obj1.translate(tx, ty, tz)
-        self.obj2.translate(tx, ty, tz)
+        obj = self.transformed()
+        obj.transform.translate(tx, ty, tz)
+        return obj
 
     def scale(self, sx, sy, sz):
-        self.obj1.scale(sx, sy, sz)
-        self.obj2.scale(sx, sy, sz)
+        obj = self.transformed()
+        obj.transform.scale(sx, sy, sz)
+        return obj
 
     def uscale(self, s):
-        self.obj1.uscale(s)
-        self.obj2.uscale(s)
+        obj = self.transformed()
+        obj.transform.isoscale(s)
+        return obj
 
     def rotatex(self, d):
-        self.obj1.rotatex(d)
-        self.obj2.rotatex(d)
+        obj = self.transformed()
+        obj.transform.rotatex(d)
+        return obj
 
     def rotatey(self, d):
-        self.obj1.rotatey(d)
-        self.obj2.rotatey(d)
+        obj = self.transformed()
+        obj.transform.rotatey(d)
+        return obj
 
     def rotatez(self, d):
-        self.obj1.rotatez(d)
-        self.obj2.rotatez(d)
+        obj = self.transformed()
+        obj.transform.rotatez(d)
+        return obj
+
+    def intersect(self, raypos, raydir):
+        return []
+
+    def closest(self, raypos, raydir, tmax=None):
+        # The first intersection of the ray, if it is closer than
+        # tmax (None is infinitely far away)
+        i = self.intersect(raypos, raydir)
+        if i and (tmax is None or i[0].distance < tmax):
+            return i[0]
+        return None
+
+    def occluded(self, raypos, raydir, maxdist=None):
+        # True if the ray crosses the surface at a distance of at most
+        # maxdist (None is infinitely far away)
+        return self.segment(raypos, raydir, maxdist) is None
+
+    def segment(self, raypos, raydir, maxdist):
+        # None if the ray crosses the surface within maxdist, otherwise
+        # whether the whole segment is inside the object
+        for i in self.intersect(raypos, raydir):
+            if maxdist is None or i.distance <= maxdist:
+                return None
+        return self.inside(raypos)
+
+    def bounds(self):
+        # world space bounding box as (lo, hi), None if unbounded
+        return None
+
+    def finalize(self, transform=None):
+        # the equivalent node to render, with the pending transforms
+        # of the operators applied to the primitives (transform is
+        # the one of the enclosing operators) and nested Unions
+        # flattened into Groups
+        return self
+
+class Operator(Node):
+    def __init__(self, obj1, obj2):
+        self.obj1 = obj1
+        self.obj2 = obj2
+        # pending transform of both operands, it is only pushed down
+        # to the primitives by finalize, so the queries below are
+        # only valid on finalized operators. The primitives then get
+        # the product of the combined matrices instead of each step
+        # applied in turn, which rounds differently in the last bits:
+        # a ray that grazes an edge can hit or miss where it did
+        # before (one pixel of snowgoon.gml at 1/8 size)
+        self.transform = Transform()
+
+    def combined_transform(self, transform):
+        if transform is None:
+            return self.transform
+        return transform.combine(self.transform)
+
+    # world space bounds, set on the finalized operators
+    bbox = None
+
+    def finalize(self, transform=None):
+        transform = self.combined_transform(transform)
+        obj = self.__class__(self.obj1.finalize(transform),
+                             self.obj2.finalize(transform))
+        obj.bbox = obj.bounds()
+        return obj
 
     def inside(self, pos):
         return self.rule(self.obj1.inside(pos), self.obj2.inside(pos))
 
+    def closest(self, raypos, raydir, tmax=None):
+        if tmax is not None and self.bbox is not None:
+            # nothing to find if the box starts beyond tmax
+            lo, hi = self.bbox
+            if lo[0] > hi[0] or lo[1] > hi[1] or lo[2] > hi[2]:
+                return None
+            if not inside_box(lo, hi, raypos):
+                t = hit_box(lo, hi, raypos, raydir)
+                if not t or t[0] >= tmax:
+                    return None
+        if self.rule(True, False) and self.rule(False, True) and \
+           not self.inside(raypos):
+            # starting outside a union, the first entry into
+            # either operand is the first intersection
+            i1 = self.obj1.closest(raypos, raydir, tmax)
+            t = tmax
+            if i1 is not None:
+                t = i1.distance
+            i = self.obj2.closest(raypos, raydir, t) or i1
+            if i is None or i.t == Intersection.ENTRY:
+                return i
+        return Node.closest(self, raypos, raydir, tmax)
+
+    def segment(self, raypos, raydir, maxdist):
+        # An operand that is entirely inside or outside along the
+        # segment may decide the result without looking at the other one
+        s1 = self.obj1.segment(raypos, raydir, maxdist)
+        if s1 is not None and self.rule(s1, False) == self.rule(s1, True):
+            return self.rule(s1, False)
+        s2 = self.obj2.segment(raypos, raydir, maxdist)
+        if s2 is not None and self.rule(False, s2) == self.rule(True, s2):
+            return self.rule(False, s2)
+        if s1 is not None and s2 is not None:
+            return self.rule(s1, s2)
+        if s1 is not None or s2 is not None:
+            # the crossing of one operand is a crossing of the result
+            return None
+        if self.rule(True, False) and self.rule(False, True) and \
+           not self.inside(raypos):
+            # the first crossing into either operand of a union
+            # that starts outside enters the union
+            return None
+        # both operands are crossed, only the full CSG merge can tell
+        return Node.segment(self, raypos, raydir, maxdist)
+
     def intersect(self, raypos, raydir):
         inside1 = 0
         inside2 = 0
@@ -144,42 +328,269 @@ class Operator(Node):
 class Union(Operator):
     def rule(self, a, b):
         return a or b
+
+    def bounds(self):
+        return merge_bounds(self.obj1.bounds(), self.obj2.bounds())
+
+    def finalize(self, transform=None):
+        # GML loops build long Union(Union(Union(...))) chains, so
+        # collect the operands without recursing
+        objs = []
+        stack = [(self, transform)]
+        while stack:
+            obj, transform = stack.pop()
+            if isinstance(obj, Union):
+                transform = obj.combined_transform(transform)
+                stack.append((obj.obj2, transform))
+                stack.append((obj.obj1, transform))
+            else:
+                objs.append(obj.finalize(transform))
+        if len(objs) == 2:
+            obj = Union(objs[0], objs[1])
+            obj.bbox = obj.bounds()
+            return obj
+        return Group(objs)
     
 class Intersect(Operator):
     def rule(self, a, b):
         return a and b
+
+    def bounds(self):
+        return intersect_bounds(self.obj1.bounds(), self.obj2.bounds())
     
 class Difference(Operator):
     def rule(self, a, b):
         return a and not b
 
+    def bounds(self):
+        return self.obj1.bounds()
+
+class Group(Node):
+    # A union of any number of objects, with a bounding volume
+    # hierarchy over the bounded ones so that a ray only visits
+    # the objects whose boxes it hits.
+    eps = 1e-7
+
+    def __init__(self, objs):
+        self.objs = objs
+        self.unbounded = []
+        leaves = []
+        eps = self.eps
+        for obj in objs:
+            b = obj.bounds()
+            if b is None:
+                self.unbounded.append(obj)
+                continue
+            lo, hi = b
+            if lo[0] > hi[0] or lo[1] > hi[1] or lo[2] > hi[2]:
+                # empty, e.g. the intersection of disjoint objects
+                continue
+            lo = (lo[0] - eps, lo[1] - eps, lo[2] - eps)
+            hi = (hi[0] + eps, hi[1] + eps, hi[2] + eps)
+            leaves.append((lo, hi, None, None, obj))
+        self.root = build_bvh(leaves)
+
+    def bounds(self):
+        if self.unbounded:
+            return None
+        if self.root is None:
+            return ((0.0, 0.0, 0.0), (-1.0, -1.0, -1.0))
+        return self.root[0], self.root[1]
+
+    def finalize(self, transform=None):
+        if transform is None:
+            return self
+        return Group([obj.finalize(transform) for obj in self.objs])
+
+    def candidates(self, raypos, raydir, maxdist=None):
+        objs = list(self.unbounded)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            t = hit_box(node[0], node[1], raypos, raydir)
+            if not t or (maxdist is not None and t[0] > maxdist):
+                continue
+            if node[4] is not None:
+                objs.append(node[4])
+            else:
+                stack.append(node[3])
+                stack.append(node[2])
+        return objs
+
+    def inside(self, pos):
+        for obj in self.unbounded:
+            if obj.inside(pos):
+                return True
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or not inside_box(node[0], node[1], pos):
+                continue
+            if node[4] is not None:
+                if node[4].inside(pos):
+                    return True
+            else:
+                stack.append(node[3])
+                stack.append(node[2])
+        return False
+
+    def closest(self, raypos, raydir, tmax=None):
+        if self.inside(raypos):
+            return Node.closest(self, raypos, raydir, tmax)
+        # starting outside, visit the boxes front to back and
+        # skip those that start beyond the closest hit so far
+        best = None
+        t = tmax
+        for obj in self.unbounded:
+            i = obj.closest(raypos, raydir, t)
+            if i is not None:
+                best = i
+                t = i.distance
+        stack = []
+        if self.root is not None:
+            root = self.root
+            stack.append((root, hit_box(root[0], root[1], raypos, raydir)))
+        while stack:
+            node, tbox = stack.pop()
+            if not tbox or (t is not None and tbox[0] >= t):
+                continue
+            if node[4] is not None:
+                i = node[4].closest(raypos, raydir, t)
+                if i is not None:
+                    best = i
+                    t = i.distance
+                continue
+            left, right = node[2], node[3]
+            tl = hit_box(left[0], left[1], raypos, raydir)
+            tr = hit_box(right[0], right[1], raypos, raydir)
+            if tl and tr and tr[0] < tl[0]:
+                stack.append((left, tl))
+                stack.append((right, tr))
+            else:
+                stack.append((right, tr))
+                stack.append((left, tl))
+        if best is not None and best.t != Intersection.ENTRY:
+            return Node.closest(self, raypos, raydir, tmax)
+        return best
+
+    def segment(self, raypos, raydir, maxdist):
+        crossed = False
+        inside = None
+        for obj in self.candidates(raypos, raydir, maxdist):
+            s = obj.segment(raypos, raydir, maxdist)
+            if s:
+                return True
+            if s is None:
+                if inside is None:
+                    inside = self.inside(raypos)
+                if not inside:
+                    # see Operator.segment
+                    return None
+                crossed = True
+        if crossed:
+            return Node.segment(self, raypos, raydir, maxdist)
+        return False
+
+    def intersect(self, raypos, raydir):
+        # same merge as Operator.intersect, but counting how many
+        # of the objects the ray is inside of
+        objs = self.candidates(raypos, raydir)
+        insides = []
+        intersections = []
+        for k, obj in enumerate(objs):
+            if obj.inside(raypos):
+                insides.append(1)
+            else:
+                insides.append(0)
+            intersections.extend([(i, k) for i in obj.intersect(raypos, raydir)])
+        intersections.sort()
+        count = len([k for k in insides if k > 0])
+        inside = count > 0
+        res = []
+        prevt = 0.0
+        for i, k in intersections:
+            before = insides[k] > 0
+            if i.t == Intersection.ENTRY:
+                insides[k] += 1
+            elif i.t == Intersection.EXIT:
+                insides[k] -= 1
+            count += (insides[k] > 0) - before
+            newinside = count > 0
+            if inside and not newinside:
+                if (i.distance - prevt) < 1e-10:
+                    # remove infinitesimal intersections
+                    res.pop()
+                else:
+                    i.switch(Intersection.EXIT)
+                    res.append(i)
+            if not inside and newinside:
+                i.switch(Intersection.ENTRY)
+                res.append(i)
+                prevt = i.distance
+            inside = newinside
+        return res
+
 class Primitive(Node):
     def __init__(self, surface):
         self.surface = surface
+        # compiled surfaces that don't read the texture coordinates
+        # tell so, and get_surface doesn't compute them
+        self.uses_uv = getattr(surface, 'uses_uv', True)
         self.transform = Transform()
 
-    def translate(self, tx, ty, tz):
-        self.transform.translate(tx, ty, tz)
-
-    def scale(self, sx, sy, sz):
-        self.transform.scale(sx, sy, sz)
+    def finalize(self, transform=None):
+        if transform is None:
+            return self
+        obj = copy.copy(self)
+        obj.transform = transform.combine(self.transform)
+        return obj
 
-    def uscale(self, s):
-        self.transform.isoscale(s)
-
-    def rotatex(self, d):
-        self.transform.rotatex(d)
-
-    def rotatey(self, d):
-        self.transform.rotatey(d)
+    def intersect_many(self, raypos, raydir):
+        # Intersect a packet of rays given as numpy arrays of shape (n, 3),
+        # raypos may also be a single point shared by all rays. Since all
+        # primitives are convex, each ray hits an interval [near, far]
+        # (distances along the ray, faces in nearface and farface), which
+        # is empty (near > far) on a miss and may be unbounded for planes.
+        # Like for intersect, only the parts with distance > 0 are crossings.
+        raypos, raydir = numpy.broadcast_arrays(numpy.asarray(raypos, float),
+                                                numpy.asarray(raydir, float))
+        tr = self.transform
+        raydir = tr.inv_transform_vectors(raydir)
+        scale = 1.0 / numpy.sqrt((raydir * raydir).sum(axis=1))
+        raydir = raydir * scale[:, numpy.newaxis] # normalize
+        raypos = tr.inv_transform_points(raypos)
+        old = numpy.seterr(divide='ignore', invalid='ignore')
+        try:
+            near, far, nearface, farface = self._intersect_many(raypos, raydir)
+        finally:
+            numpy.seterr(**old)
+        return near * scale, far * scale, nearface, farface
 
-    def rotatez(self, d):
-        self.transform.rotatez(d)
+    def bounds(self):
+        lo, hi = self.box
+        tr = self.transform
+        corners = [tr.transform_point((x, y, z))
+                   for x in (lo[0], hi[0])
+                   for y in (lo[1], hi[1])
+                   for z in (lo[2], hi[2])]
+        return ((min([c[0] for c in corners]),
+                 min([c[1] for c in corners]),
+                 min([c[2] for c in corners])),
+                (max([c[0] for c in corners]),
+                 max([c[1] for c in corners]),
+                 max([c[2] for c in corners])))
 
     def get_surface(self, i):
-        def yellow(face, u, v):
-            return (0.1, 1.0, 1.0), 0.4, 0.05, 4
-        return yellow
+        if not self.uses_uv:
+            return self.surface(i.face, 0.0, 0.0)
+        u, v = self.get_uv(i)
+        return self.surface(i.face, u, v)
+
+def packet_miss(hit, near, far):
+    return (numpy.where(hit, near, numpy.inf),
+            numpy.where(hit, far, -numpy.inf))
 
 def atan2(a, b):
     c = 0.5 * math.atan2(a, b) / math.pi
@@ -188,6 +599,8 @@ def atan2(a, b):
     return c    
 
 class Sphere(Primitive):
+    box = ((-1.0, -1.0, -1.0), (1.0, 1.0, 1.0))
+
     def intersect(self, raypos, raydir):
         tr = self.transform
         raydir = tr.inv_transform_vector(raydir)
@@ -213,20 +626,31 @@ class Sphere(Primitive):
             ts.append(Intersection(scale, t2, raypos, raydir, self, Intersection.EXIT, 0))
         return ts
 
+    def _intersect_many(self, raypos, raydir):
+        s = -(raypos * raydir).sum(axis=1)
+        lsq = (raypos * raypos).sum(axis=1)
+        msq = lsq - s * s
+        hit = ~((s < 0.0) & (lsq > 1.0)) & (msq <= 1.0)
+        q = numpy.sqrt(numpy.where(hit, 1.0 - msq, 0.0))
+        near, far = packet_miss(hit, s - q, s + q)
+        faces = numpy.zeros(len(s), int)
+        return near, far, faces, faces
+
     def inside(self, pos):
         x, y, z = self.transform.inv_transform_point(pos)
         return (x * x + y * y + z * z) <= 1.0        
 
-    def get_surface(self, i):
+    def get_uv(self, i):
         x, y, z = i.opos
         v = (y + 1.0) / 2.0
         u = atan2(x, z)
-        return self.surface(i.face, u, v)
+        return u, v
 
     def get_normal(self, i):
         return normalize(self.transform.transform_normal(i.opos))
 
 class Cube(Primitive):
+    box = ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0))
     normals = [(0.0, 0.0, -1.0),
                (0.0, 0.0, 1.0),
                (-1.0, 0.0, 0.0),
@@ -274,25 +698,58 @@ class Cube(Primitive):
             ts.append(Intersection(scale, tmax[0], raypos, raydir, self, Intersection.EXIT, tmax[1]))
         return ts
         
+    def _intersect_many(self, raypos, raydir):
+        eps = 1e-15
+        n = len(raypos)
+        tmin = numpy.empty(n)
+        tmin.fill(-numpy.inf)
+        tmax = numpy.empty(n)
+        tmax.fill(numpy.inf)
+        facemin = numpy.zeros(n, int)
+        facemax = numpy.zeros(n, int)
+        hit = numpy.ones(n, bool)
+        p = 0.5 - raypos
+        for i in range(3):
+            face1, face2 = self.slabs[i]
+            e = p[:, i]
+            f = raydir[:, i]
+            parallel = abs(f) <= eps
+            t1 = (e + 0.5) / f
+            t2 = (e - 0.5) / f
+            swap = t1 > t2
+            t1, t2 = numpy.where(swap, t2, t1), numpy.where(swap, t1, t2)
+            f1 = numpy.where(swap, face2, face1)
+            f2 = numpy.where(swap, face1, face2)
+            update = ~parallel & (t1 > tmin)
+            tmin = numpy.where(update, t1, tmin)
+            facemin = numpy.where(update, f1, facemin)
+            update = ~parallel & (t2 < tmax)
+            tmax = numpy.where(update, t2, tmax)
+            facemax = numpy.where(update, f2, facemax)
+            hit &= ~(parallel & ((-e - 0.5 > 0.0) | (-e + 0.5 < 0.0)))
+        hit &= tmin <= tmax
+        tmin, tmax = packet_miss(hit, tmin, tmax)
+        return tmin, tmax, facemin, facemax
+
     def inside(self, pos):
         x, y, z = self.transform.inv_transform_point(pos)        
         return 0.0 <= x <= 1.0 and 0.0 <= y <= 1.0 and 0.0 <= z <= 1.0
 
-    def get_surface(self, i):
+    def get_uv(self, i):
         x, y, z = i.opos
         face = i.face
         if face == 0:
-            return self.surface(0, x, y)
+            return x, y
         elif face == 1:
-            return self.surface(1, x, y)
+            return x, y
         elif face == 2:
-            return self.surface(2, z, y)
+            return z, y
         elif face == 3:
-            return self.surface(3, z, y)
+            return z, y
         elif face == 4:
-            return self.surface(4, x, z)
+            return x, z
         elif face == 5:
-            return self.surface(5, x, z)
+            return x, z
         else:
             print opos
             assert False
@@ -301,6 +758,8 @@ class Cube(Primitive):
         return normalize(self.transform.transform_normal(self.normals[i.face]))
 
 class Cylinder(Primitive):
+    box = ((-1.0, 0.0, -1.0), (1.0, 1.0, 1.0))
+
     def _solveCyl(self, px, pz, dx, dz):
         # solve x ^ 2 + z ^ 2 = 1
         # (px + t * dx) ^ 2 + (pz + t * dz) ^ 2 = 1
@@ -392,19 +851,66 @@ class Cylinder(Primitive):
             ts.append(Intersection(scale, tmax[0], raypos, raydir, self, Intersection.EXIT, tmax[1]))
         return ts
 
+    def _intersect_many(self, raypos, raydir):
+        eps = 1e-7
+        px, py, pz = raypos.T
+        dx, dy, dz = raydir.T
+        # cylinder, as in _solveCyl
+        a = dx * dx + dz * dz
+        b = 2 * (px * dx + pz * dz)
+        c = px * px + pz * pz - 1.0
+        sq = b * b - 4 * a * c
+        cyl = sq >= 0.0
+        root = numpy.sqrt(numpy.where(cyl, sq, 0.0))
+        tc1 = (-b - root) / (2.0 * a)
+        tc2 = (-b + root) / (2.0 * a)
+        # planes, as in _solvePlane
+        dinv = 1.0 / dy
+        t1 = -py * dinv
+        t2 = (-py + 1.0) * dinv
+        swap = t1 > t2
+        tp1 = numpy.where(swap, t2, t1)
+        tp2 = numpy.where(swap, t1, t2)
+        fp1 = numpy.where(swap, 1, 2)
+        fp2 = numpy.where(swap, 2, 1)
+        parallel = abs(dy) + eps >= 1.0
+        orthogonal = abs(dy) < eps
+        # general case, same min-max strategy as for cubes
+        cmin = tc1 > tp1
+        cmax = tc2 <= tp2
+        tmin = numpy.where(cmin, tc1, tp1)
+        tmax = numpy.where(cmax, tc2, tp2)
+        facemin = numpy.where(cmin, 0, fp1)
+        facemax = numpy.where(cmax, 0, fp2)
+        hit = cyl & (tmin <= tmax)
+        # ray is orthogonal to the cylinder axis
+        tmin = numpy.where(orthogonal, tc1, tmin)
+        tmax = numpy.where(orthogonal, tc2, tmax)
+        facemin = numpy.where(orthogonal, 0, facemin)
+        facemax = numpy.where(orthogonal, 0, facemax)
+        hit = numpy.where(orthogonal, cyl & (py >= 0.0) & (py <= 1.0), hit)
+        # ray is parallel to the cylinder axis
+        tmin = numpy.where(parallel, tp1, tmin)
+        tmax = numpy.where(parallel, tp2, tmax)
+        facemin = numpy.where(parallel, fp1, facemin)
+        facemax = numpy.where(parallel, fp2, facemax)
+        hit = numpy.where(parallel, 1.0 - px * px - pz * pz >= 0.0, hit)
+        tmin, tmax = packet_miss(hit, tmin, tmax)
+        return tmin, tmax, facemin, facemax
+
     def inside(self, pos):
         x, y, z = self.transform.inv_transform_point(pos)
         return (x * x + z * z) <= 1.0 and 0.0 <= y <= 1.0
 
-    def get_surface(self, i):
+    def get_uv(self, i):
         x, y, z = i.opos
         face = i.face
         if face == 0:
-            return self.surface(0, atan2(x, z), y)
+            return atan2(x, z), y
         elif face == 1:
-            return self.surface(1, (x + 1.0) / 2.0, (z + 1.0) / 2.0)
+            return (x + 1.0) / 2.0, (z + 1.0) / 2.0
         elif face == 2:
-            return self.surface(2, (x + 1.0) / 2.0, (z + 1.0) / 2.0)
+            return (x + 1.0) / 2.0, (z + 1.0) / 2.0
         else:
             print face
             raise
@@ -420,6 +926,8 @@ class Cylinder(Primitive):
     
 
 class Cone(Primitive):
+    box = ((-1.0, 0.0, -1.0), (1.0, 1.0, 1.0))
+
     def _solveCone(self, px, py, pz, dx, dy, dz):
         # solve x ^ 2 + z ^ 2 = y ^ 2
         # (px + t * dx) ^ 2 + (pz + t * dz) ^ 2 = (py + t * dy) ^ 2
@@ -482,17 +990,48 @@ class Cone(Primitive):
             tr.append(Intersection(scale, ts[1][0], raypos, raydir, self, Intersection.EXIT, ts[1][1]))
         return tr
        
+    def _intersect_many(self, raypos, raydir):
+        px, py, pz = raypos.T
+        dx, dy, dz = raydir.T
+        # cone, as in _solveCone
+        a = dx * dx + dz * dz - dy * dy
+        b = 2 * (px * dx + pz * dz - py * dy)
+        c = px * px + pz * pz - py * py
+        sq = b * b - 4 * a * c
+        cone = sq >= 0.0
+        root = numpy.sqrt(numpy.where(cone, sq, 0.0))
+        t1 = (-b - root) / (2.0 * a)
+        t2 = (-b + root) / (2.0 * a)
+        swap = t1 > t2
+        t1, t2 = numpy.where(swap, t2, t1), numpy.where(swap, t1, t2)
+        y1 = py + t1 * dy
+        y2 = py + t2 * dy
+        valid1 = cone & (0.0 <= y1) & (y1 <= 1.0)
+        valid2 = cone & (0.0 <= y2) & (y2 <= 1.0)
+        # with only one intersection with the cone,
+        # the other one must be in the base
+        tc = numpy.where(valid1, t1, t2)
+        tp = (-py + 1.0) / dy
+        conefirst = tc <= tp
+        both = valid1 & valid2
+        tmin = numpy.where(both, t1, numpy.where(conefirst, tc, tp))
+        tmax = numpy.where(both, t2, numpy.where(conefirst, tp, tc))
+        facemin = numpy.where(both | conefirst, 0, 1)
+        facemax = numpy.where(both | ~conefirst, 0, 1)
+        tmin, tmax = packet_miss(valid1 | valid2, tmin, tmax)
+        return tmin, tmax, facemin, facemax
+
     def inside(self, pos):
         x, y, z = self.transform.inv_transform_point(pos)
         return (x * x - y * y + z * z) <= 0.0 and 0.0 <= y <= 1.0
 
-    def get_surface(self, i):
+    def get_uv(self, i):
         x, y, z = i.opos
         face = i.face
         if face == 0:
-            return self.surface(0, atan2(x, z), y)
+            return atan2(x, z), y
         elif face == 1:
-            return self.surface(1, (x + 1.0) / 2.0, (z + 1.0) / 2.0)
+            return (x + 1.0) / 2.0, (z + 1.0) / 2.0
 
     def get_normal(self, i):
         if i.face == 0:
@@ -505,6 +1044,10 @@ class Cone(Primitive):
 
 class Plane(Primitive):
     np = (0.0, 1.0, 0.0)
+
+    def bounds(self):
+        return None
+
     def intersect(self, raypos, raydir):
         tr = self.transform
         raydir = tr.inv_transform_vector(raydir)
@@ -523,12 +1066,55 @@ class Plane(Primitive):
         else:
             return [Intersection(scale, t, raypos, raydir, self, Intersection.ENTRY, 0)]
             
+    def _intersect_many(self, raypos, raydir):
+        py = raypos[:, 1]
+        denom = raydir[:, 1]
+        t = -py / denom
+        hit = (abs(denom) >= 1e-7) & (t >= 0.0)
+        exit = denom > 0.0
+        tmin, tmax = packet_miss(hit,
+                                 numpy.where(exit, -numpy.inf, t),
+                                 numpy.where(exit, t, numpy.inf))
+        faces = numpy.zeros(len(t), int)
+        return tmin, tmax, faces, faces
+
     def inside(self, pos):
         return self.transform.inv_transform_py(pos) <= 0.0
 
-    def get_surface(self, i):
+    def get_uv(self, i):
         x, y, z = i.opos
-        return self.surface(0, x, z)
+        return x, z
 
     def get_normal(self, i):
         return normalize(self.transform.transform_normal(self.np))
+
+if __name__=="__main__":
+    import random
+
+    def test(prim, n=1000):
+        # compare the packet kernel with the scalar intersect
+        random.seed(17)
+        raypos = [(random.uniform(-3, 3), random.uniform(-3, 3), random.uniform(-3, 3)) for k in range(n)]
+        raydir = [normalize((random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1))) for k in range(n)]
+        near, far, nearface, farface = prim.intersect_many(raypos, raydir)
+        for k in range(n):
+            res = []
+            if near[k] <= far[k]:
+                if 0.0 < near[k] < numpy.inf:
+                    res.append((near[k], Intersection.ENTRY, nearface[k]))
+                if 0.0 < far[k] < numpy.inf:
+                    res.append((far[k], Intersection.EXIT, farface[k]))
+            ref = [(i.distance, i.t, i.face) for i in prim.intersect(raypos[k], raydir[k])]
+            if len(res) != len(ref) or [r[1:] for r in res] != [r[1:] for r in ref] or \
+               max([abs(a[0] - b[0]) for a, b in zip(res, ref)] + [0.0]) > 1e-9:
+                print prim.__class__.__name__, raypos[k], raydir[k], res, "!=", ref
+                return
+        print prim.__class__.__name__, "OK"
+
+    for cls in [Sphere, Cube, Cylinder, Cone, Plane]:
+        prim = cls(None)
+        prim = prim.scale(1.5, 0.5, 2.0)
+        prim = prim.rotatex(30.0)
+        prim = prim.rotatez(-70.0)
+        prim = prim.translate(0.2, -0.3, 0.5)
+        test(prim)
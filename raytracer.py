@@ -1,7 +1,7 @@
 import math
 from vecmat import normalize, add, sub, cmul, neg, mul, dot, length, cross
 from transform import Transform
-from ppmwriter import write_ppm
+from ppmwriter import PPMWriter, pack_pixels
 import evaluator
 from primitives import Sphere, Plane, Cube, Cylinder, Cone, Union, Intersect, Difference, Intersection
 from lights import Light, PointLight, SpotLight
@@ -17,12 +17,8 @@ def get_specular(ic, lightdir, sn, pos, raypos, n):
     return (0.0, 0.0, 0.0)
 
 def trace(amb, lights, scene, depth, raypos, raydir):
-    i = scene.intersect(raypos, raydir)
-    if i:
-        #for ic in i:
-        #    print ic
-        #print
-        isect = i[0]
+    isect = scene.closest(raypos, raydir)
+    if isect is not None:
         if isect.t == Intersection.EXIT:
             return (0.0, 0.0, 0.0)
         sc, kd, ks, n = isect.primitive.get_surface(isect)
@@ -36,8 +32,7 @@ def trace(amb, lights, scene, depth, raypos, raydir):
             df = dot(normal, lightdir)
             if df > 0.0:
                 poseps = add(pos, mul(lightdir, 1e-7))
-                i = scene.intersect(poseps, lightdir)
-                if not i or (lightdistance and (lightdistance < i[0].distance)):
+                if not scene.occluded(poseps, lightdir, lightdistance or None):
                     ic = cmul(sc, light.get_intensity(pos))
                     if kd > 0.0:
                         diffuse = add(diffuse, mul(ic, df))
@@ -54,25 +49,96 @@ def trace(amb, lights, scene, depth, raypos, raydir):
     else:
         return (0.0, 0.0, 0.0)
 
-def render(amb, lights, obj, depth, fov, w, h, filename):
-    print "Rendering", filename
-    pixels = []
+# Number of worker processes used by render, 1 renders serially in-process
+workers = 1
+
+# Side of the square tiles handed out to the worker processes
+tilesize = 32
+
+def get_camera(fov, w, h):
     raypos = (0.0, 0.0, -1.0)
-    w_world = 2.0 * math.tan(0.5 * math.radians(fov))    
+    w_world = 2.0 * math.tan(0.5 * math.radians(fov))
     h_world = h * w_world / w
-    c_x = -0.5 * w_world 
+    c_x = -0.5 * w_world
     c_y = 0.5 * h_world
     pw = w_world/w
-    for y in range(h):
-        for x in range(w):
+    return raypos, c_x, c_y, pw
+
+def render_tile(amb, lights, obj, depth, camera, x0, y0, x1, y1):
+    raypos, c_x, c_y, pw = camera
+    pixels = []
+    for y in range(y0, y1):
+        for x in range(x0, x1):
             raydir = normalize((c_x + (x + 0.5) * pw, c_y - (y + 0.5) * pw, -raypos[2]))
             p = trace(amb, lights, obj, depth, raypos, raydir)
             pixels.append(p)
-    print "Writing", filename
-    write_ppm(pixels, w, h, filename)
+    return pixels
+
+def get_tiles(w, h, size):
+    tiles = []
+    for y0 in range(0, h, size):
+        for x0 in range(0, w, size):
+            tiles.append((x0, y0, min(x0 + size, w), min(y0 + size, h)))
+    return tiles
+
+# The scene of a worker process, set once by _init_worker
+_worker_scene = None
+
+def _init_worker(scene):
+    global _worker_scene
+    _worker_scene = scene
+
+def _render_worker_tile(tile):
+    amb, lights, obj, depth, camera = _worker_scene
+    x0, y0, x1, y1 = tile
+    return tile, pack_pixels(render_tile(amb, lights, obj, depth, camera, x0, y0, x1, y1))
+
+def render_parallel(amb, lights, obj, depth, camera, w, h, nworkers, writer):
+    from multiprocessing import Pool
+    # The workers are forked, so the scene (including the surface
+    # closures, which can't be pickled) is inherited once per worker
+    # and only tile coordinates and pixels pass between processes.
+    pool = Pool(nworkers, _init_worker, ((amb, lights, obj, depth, camera),))
+    try:
+        for tile, data in pool.imap_unordered(_render_worker_tile,
+                                              get_tiles(w, h, tilesize)):
+            x0, y0, x1, y1 = tile
+            writer.write_tile(x0, y0, x1, y1, data)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def render(amb, lights, obj, depth, fov, w, h, filename, nworkers=None):
+    print "Rendering", filename
+    if nworkers is None:
+        nworkers = workers
+    obj = obj.finalize()
+    camera = get_camera(fov, w, h)
+    # Rows go to the file as they are finished, a band at a time
+    writer = PPMWriter(filename, w, h)
+    try:
+        if nworkers > 1:
+            render_parallel(amb, lights, obj, depth, camera, w, h, nworkers, writer)
+        else:
+            for y0 in range(0, h, tilesize):
+                y1 = min(y0 + tilesize, h)
+                pixels = render_tile(amb, lights, obj, depth, camera, 0, y0, w, y1)
+                writer.write_rows(pack_pixels(pixels))
+        print "Writing", filename
+    except:
+        writer.abort()
+        raise
+    writer.close()
 
 if __name__=="__main__":
     import sys
+    if "-j" in sys.argv:
+        i = sys.argv.index("-j")
+        workers = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
     if len(sys.argv) > 1 and sys.argv[1] == "-p":
         try:
             import psyco
@@ -94,7 +160,7 @@ if __name__=="__main__":
             return (0.1, 1.0, 1.0), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         p = Plane(yellow)
-        p.translate(0.0, -4.0, 0.0)
+        p = p.translate(0.0, -4.0, 0.0)
         return p, l
 
     def scene_cube():
@@ -102,10 +168,10 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cube(red)
-        c.translate(-0.5, -0.5, -0.5)
-        c.rotatex(10.0)
-        c.rotatey(20.0)
-        c.rotatez(30.0)
+        c = c.translate(-0.5, -0.5, -0.5)
+        c = c.rotatex(10.0)
+        c = c.rotatey(20.0)
+        c = c.rotatez(30.0)
         return c, l
 
     def scene_cylinder():
@@ -113,10 +179,10 @@ if __name__=="__main__":
             return (0.1, 1.0, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cylinder(green)
-        c.translate(0.0, -0.5, 0.0)
-        c.rotatex(60.0)
-        c.rotatey(20.0)
-        c.rotatez(40.0)
+        c = c.translate(0.0, -0.5, 0.0)
+        c = c.rotatex(60.0)
+        c = c.rotatey(20.0)
+        c = c.rotatez(40.0)
         return c, l
 
     def scene_cone():
@@ -124,8 +190,8 @@ if __name__=="__main__":
             return (0.1, 1.0, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cone(green)
-        c.translate(0.0, -0.5, 0.0)
-        c.scale(2.0, 4.0, 2.0)
+        c = c.translate(0.0, -0.5, 0.0)
+        c = c.scale(2.0, 4.0, 2.0)
         #c.rotatex(90.0)
         return c, l
 
@@ -155,10 +221,10 @@ if __name__=="__main__":
             return (r, g, b), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cylinder(pattern)
-        c.translate(0.0, -0.5, 0.0)
-        c.rotatex(60.0)
-        c.rotatey(20.0)
-        c.rotatez(40.0)
+        c = c.translate(0.0, -0.5, 0.0)
+        c = c.rotatex(60.0)
+        c = c.rotatey(20.0)
+        c = c.rotatez(40.0)
         return c, l
 
     def scene_texcylinder2():
@@ -182,10 +248,10 @@ if __name__=="__main__":
                 return (0.1, 0.1, 1.0), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cylinder(test)
-        c.translate(0.0, -0.5, 0.0)
-        c.rotatex(60.0)
-        c.rotatey(20.0)
-        c.rotatez(40.0)
+        c = c.translate(0.0, -0.5, 0.0)
+        c = c.rotatex(60.0)
+        c = c.rotatey(20.0)
+        c = c.rotatez(40.0)
         return c, l
 
     def scene_texcone():
@@ -200,8 +266,8 @@ if __name__=="__main__":
             return (r, g, b), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cone(pattern)
-        c.translate(0.0, -0.5, 0.0)
-        c.scale(2.0, 4.0, 2.0)
+        c = c.translate(0.0, -0.5, 0.0)
+        c = c.scale(2.0, 4.0, 2.0)
         #c.rotatex(90.0)
         return c, l
 
@@ -217,7 +283,7 @@ if __name__=="__main__":
             return (r, g, b), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         p = Plane(pattern)
-        p.translate(0.0, -4.0, 0.0)
+        p = p.translate(0.0, -4.0, 0.0)
         return p, l
 
     def scene_texcube():
@@ -232,10 +298,10 @@ if __name__=="__main__":
             return (r, g, b), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c = Cube(pattern)
-        c.translate(-0.5, -0.5, -0.5)
-        c.rotatex(10.0)
-        c.rotatey(20.0)
-        c.rotatez(30.0)
+        c = c.translate(-0.5, -0.5, -0.5)
+        c = c.rotatex(10.0)
+        c = c.rotatey(20.0)
+        c = c.rotatez(30.0)
         return c, l
 
     def scene_union():
@@ -245,9 +311,9 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         s1 = Sphere(blue)
-        s1.translate(-0.6, 0.0, 0.0)
+        s1 = s1.translate(-0.6, 0.0, 0.0)
         s2 = Sphere(red)
-        s2.translate(0.6, 0.0, 0.0)
+        s2 = s2.translate(0.6, 0.0, 0.0)
         u = Union(s1, s2)
         return u, l
 
@@ -258,9 +324,9 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         s1 = Sphere(blue)
-        s1.translate(-0.6, 0.0, 0.0)
+        s1 = s1.translate(-0.6, 0.0, 0.0)
         s2 = Sphere(red)
-        s2.translate(0.6, 0.0, 0.0)
+        s2 = s2.translate(0.6, 0.0, 0.0)
         i = Intersect(s1, s2)
         return i, l
 
@@ -271,14 +337,14 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c1 = Cylinder(blue)
-        c1.translate(0.0, -0.5, 0.0)
+        c1 = c1.translate(0.0, -0.5, 0.0)
         c2 = Cylinder(red)
-        c2.translate(0.0, -0.5, 0.0)
-        c2.scale(0.8, 1.2, 0.8)
+        c2 = c2.translate(0.0, -0.5, 0.0)
+        c2 = c2.scale(0.8, 1.2, 0.8)
         d = Difference(c1, c2)
-        d.rotatex(60.0)
-        d.rotatey(20.0)
-        d.rotatez(40.0)
+        d = d.rotatex(60.0)
+        d = d.rotatey(20.0)
+        d = d.rotatez(40.0)
         return d, l
 
     def scene_difference2():
@@ -289,12 +355,12 @@ if __name__=="__main__":
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c1 = Sphere(blue)
         c2 = Cylinder(red)
-        c2.translate(0.0, -0.5, 0.0)
-        c2.scale(0.4, 2.0, 0.4)
+        c2 = c2.translate(0.0, -0.5, 0.0)
+        c2 = c2.scale(0.4, 2.0, 0.4)
         d = Difference(c1, c2)
-        d.rotatex(85.0)
-        d.rotatey(20.0)
-        d.rotatez(40.0)
+        d = d.rotatex(85.0)
+        d = d.rotatey(20.0)
+        d = d.rotatez(40.0)
         return d, l
 
     def scene_difference3():
@@ -304,17 +370,17 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         c1 = Cone(blue)
-        c1.translate(0.0, -0.5, 0.0)
-        c1.scale(1.0, 3.0, 1.0)
+        c1 = c1.translate(0.0, -0.5, 0.0)
+        c1 = c1.scale(1.0, 3.0, 1.0)
         c2 = Cube(red)
-        c2.translate(-0.5, 1.0, -0.5)
+        c2 = c2.translate(-0.5, 1.0, -0.5)
         c3 = Cube(red)
-        c3.translate(-0.5, -1.5, -0.5)
+        c3 = c3.translate(-0.5, -1.5, -0.5)
         u = Union(c2, c3)
         d = Difference(c1, u)
-        d.rotatex(85.0)
-        d.rotatey(20.0)
-        d.rotatez(40.0)
+        d = d.rotatex(85.0)
+        d = d.rotatey(20.0)
+        d = d.rotatez(40.0)
         return d, l
 
     def scene_planes():
@@ -324,30 +390,30 @@ if __name__=="__main__":
             return (1.0, 0.1, 0.1), 0.3, 0.2, 6
         l = [PointLight((1.0, 1.0, -1.0), (1.0, 1.0, 1.0))]
         p1 = Plane(blue)
-        p1.rotatez(30)
-        p1.translate(0.0, -2.0, 0.0)
+        p1 = p1.rotatez(30)
+        p1 = p1.translate(0.0, -2.0, 0.0)
         p2 = Plane(blue)
-        p2.rotatez(-30)
-        p2.translate(0.0, -2.0, 0.0)
+        p2 = p2.rotatez(-30)
+        p2 = p2.translate(0.0, -2.0, 0.0)
         p3 = Plane(red)
-        p3.rotatex(-90)
-        p3.translate(0.0, 0.0, -1.0)
+        p3 = p3.rotatex(-90)
+        p3 = p3.translate(0.0, 0.0, -1.0)
         p4 = Plane(blue)
-        p4.rotatez(180)
-        p4.translate(0.0, -4.0, 0.0)
+        p4 = p4.rotatez(180)
+        p4 = p4.translate(0.0, -4.0, 0.0)
         p5 = Plane(red)
-        p5.rotatex(90)
-        p5.translate(0.0, 0.0, 1.0)
+        p5 = p5.rotatex(90)
+        p5 = p5.translate(0.0, 0.0, 1.0)
         obj = Intersect(Intersect(Intersect(p1, p2), Intersect(p3, p4)), p5)
-        obj.translate(0.0, 3.0, 0.0)
-        obj.rotatex(50)
-        obj.rotatey(20)
-        obj.rotatez(30)
-        obj.translate(0.0, 0.0, 3.0)
+        obj = obj.translate(0.0, 3.0, 0.0)
+        obj = obj.rotatex(50)
+        obj = obj.rotatey(20)
+        obj = obj.rotatez(30)
+        obj = obj.translate(0.0, 0.0, 3.0)
         return obj, l
         p6 = Plane(blue)
-        p6.translate(0.0, 0.0, 0.0)
-        p6.rotatex(270)
+        p6 = p6.translate(0.0, 0.0, 0.0)
+        p6 = p6.rotatex(270)
         i1 = Intersect(p1, p2)
         i2 = Intersect(p3, p4)
         i3 = Intersect(p5, p6)
@@ -377,19 +443,19 @@ if __name__=="__main__":
             return (1.0, 1.0, 1.0), 0.3, 0.2, 6
         def apex(rot):
             p1 = Plane(white)
-            p1.rotatex(90)
+            p1 = p1.rotatex(90)
             p2 = Plane(red)
-            p2.rotatex(-90)
-            p2.rotatey(30)
+            p2 = p2.rotatex(-90)
+            p2 = p2.rotatey(30)
             i = Intersect(p1, p2)
-            i.rotatey(rot)
+            i = i.rotatey(rot)
             return i
         l = [Light((1.0, -1.0, 1.0), (1.0, 1.0, 1.0))]
         cyl3 = Cylinder(red)
-        cyl3.scale(0.9999, 0.9999, 0.999)
-        cyl3.translate(0.0, 3.0, 0.0)
+        cyl3 = cyl3.scale(0.9999, 0.9999, 0.999)
+        cyl3 = cyl3.translate(0.0, 3.0, 0.0)
         cyl4 = Cylinder(blue)
-        cyl4.scale(0.7, 4.0, 0.7)
+        cyl4 = cyl4.scale(0.7, 4.0, 0.7)
         a1 = apex(15)
         a2 = apex(75)
         a3 = apex(135)
@@ -400,22 +466,22 @@ if __name__=="__main__":
         cyl5 = Cylinder(magenta)
         i2 = Intersect(u3, cyl5)
         u4 = Union(cyl4, i2)
-        u4.translate(0.0, 3.5, 0.0)
+        u4 = u4.translate(0.0, 3.5, 0.0)
         d = Difference(cyl3, u4)        
-        d.translate(0.0, -4.0, 2.0)
-        d.uscale(4.0)
-        d.rotatex(-50)
+        d = d.translate(0.0, -4.0, 2.0)
+        d = d.uscale(4.0)
+        d = d.rotatex(-50)
         return d, l
         
         
         d1 = Difference(u2, u4)
         #d1.uscale(0.4)
-        d1.translate(0.0, -3.0, 2.0)
-        d1.rotatex(-50)
+        d1 = d1.translate(0.0, -3.0, 2.0)
+        d1 = d1.rotatex(-50)
         return d1, l
         
     def render_scene(scene, lights, name):
-        scene.translate(0.0, 0.0, 3.0)
+        scene = scene.translate(0.0, 0.0, 3.0)
         render((1.0, 1.0, 1.0),
                lights,
                scene,
@@ -0,0 +1,373 @@
+import types
+import gmlmath
+
+# Compiles the closure of a GML surface function into a Python
+# function of (face, u, v), so that the renderer doesn't have to run
+# the interpreter for every hit. The closure body is evaluated
+# symbolically: the stack holds Python expressions (with their GML
+# types) instead of values, every operator emits one assignment to a
+# fresh variable, and apply and if are inlined, with the closures
+# they call known at compile time. Anything the compiler can't handle
+# raises CompileError, and the caller falls back to the interpreter.
+
+class CompileError(Exception):
+    pass
+
+# operator: (operand types, result type, Python expression)
+operators = {
+    'addi': (('Integer', 'Integer'), 'Integer', '%s + %s'),
+    'addf': (('Real', 'Real'), 'Real', '%s + %s'),
+    'subi': (('Integer', 'Integer'), 'Integer', '%s - %s'),
+    'subf': (('Real', 'Real'), 'Real', '%s - %s'),
+    'muli': (('Integer', 'Integer'), 'Integer', '%s * %s'),
+    'mulf': (('Real', 'Real'), 'Real', '%s * %s'),
+    'divi': (('Integer', 'Integer'), 'Integer', 'divi(%s, %s)'),
+    'divf': (('Real', 'Real'), 'Real', '%s / %s'),
+    'modi': (('Integer', 'Integer'), 'Integer', 'modi(%s, %s)'),
+    'negi': (('Integer',), 'Integer', '-%s'),
+    'negf': (('Real',), 'Real', '-%s'),
+    'eqi': (('Integer', 'Integer'), 'Boolean', '%s == %s'),
+    'eqf': (('Real', 'Real'), 'Boolean', '%s == %s'),
+    'lessi': (('Integer', 'Integer'), 'Boolean', '%s < %s'),
+    'lessf': (('Real', 'Real'), 'Boolean', '%s < %s'),
+    'acos': (('Real',), 'Real', 'acos(%s)'),
+    'asin': (('Real',), 'Real', 'asin(%s)'),
+    'clampf': (('Real',), 'Real', 'clampf(%s)'),
+    'cos': (('Real',), 'Real', 'cos(%s)'),
+    'sin': (('Real',), 'Real', 'sin(%s)'),
+    'sqrt': (('Real',), 'Real', 'sqrt(%s)'),
+    'floor': (('Real',), 'Integer', 'floor(%s)'),
+    'frac': (('Real',), 'Real', 'frac(%s)'),
+    'real': (('Integer',), 'Real', 'float(%s)'),
+    'point': (('Real', 'Real', 'Real'), 'Point', '(%s, %s, %s)'),
+    'getx': (('Point',), 'Real', '%s[0]'),
+    'gety': (('Point',), 'Real', '%s[1]'),
+    'getz': (('Point',), 'Real', '%s[2]'),
+}
+
+# what get raises for an index out of range, the evaluator sets it to
+# its GMLSubscriptError
+subscript_error = IndexError
+
+def get(a, i):
+    if i < 0 or i >= len(a):
+        raise subscript_error
+    return a[i]
+
+# the globals of the compiled functions
+runtime = {'get': get, 'len': len, 'float': float}
+for name in ['divi', 'modi', 'acos', 'asin', 'clampf', 'cos', 'sin',
+             'sqrt', 'floor', 'frac']:
+    runtime[name] = getattr(gmlmath, name)
+
+# limits for inlining, recursive closures are left to the interpreter
+max_depth = 64
+max_lines = 4000
+
+class Value(object):
+    # a runtime value of a known GML type, computed by expr, arrays
+    # have the type ('Array', element type) and are Python lists
+    def __init__(self, type, expr):
+        self.type = type
+        self.expr = expr
+
+class Closure(object):
+    # a closure known at compile time
+    def __init__(self, scope, ast):
+        self.scope = scope
+        self.ast = ast
+
+class Scope(object):
+    # the compile time environment, names bound in the compiled code
+    # on top of the GML environment the surface closure captured
+    def __init__(self, names, env):
+        self.names = names
+        self.env = env
+
+    def bind(self, name, value):
+        names = dict(self.names)
+        names[name] = value
+        return Scope(names, self.env)
+
+class Compiler(object):
+    def __init__(self):
+        self.nvars = 0
+        self.nlines = 0
+        self.depth = 0
+        self.consts = {}
+        self.const_names = {}
+        # the parameters the compiled code reads
+        self.uses = set()
+
+    def var(self):
+        self.nvars += 1
+        return "_%d" % self.nvars
+
+    def emit(self, lines, indent, line):
+        self.nlines += 1
+        if self.nlines > max_lines:
+            raise CompileError
+        lines.append("    " * indent + line)
+
+    def use(self, value):
+        if value.expr in ['face', 'u', 'v']:
+            self.uses.add(value.expr)
+        return value.expr
+
+    def unbox(self, value):
+        # the GML type of a runtime value
+        t = type(value)
+        if t is bool:
+            return 'Boolean'
+        if t is int:
+            return 'Integer'
+        if t is float:
+            return 'Real'
+        if t is tuple:
+            return 'Point'
+        if t is list:
+            elemtype = None
+            for e in value:
+                et = self.unbox(e)
+                if elemtype is not None and et != elemtype:
+                    raise CompileError
+                elemtype = et
+            return ('Array', elemtype)
+        raise CompileError
+
+    def const(self, value):
+        # values from the captured environment are passed as globals,
+        # so that closures that only differ in them share the code
+        key = id(value)
+        if key not in self.const_names:
+            name = "_k%d" % len(self.consts)
+            self.const_names[key] = Value(self.unbox(value), name)
+            self.consts[name] = value
+        return self.const_names[key]
+
+    def literal(self, t, v):
+        if t in ['Integer', 'Real', 'Boolean']:
+            if v != v or v in [float('inf'), float('-inf')]:
+                raise CompileError
+            return Value(t, "(%r)" % v)
+        raise CompileError
+
+    def lookup(self, scope, name):
+        if name in scope.names:
+            return scope.names[name]
+        if name not in scope.env:
+            raise CompileError
+        value = scope.env[name]
+        if hasattr(value, 'code'):
+            # the interpreter's closures hold compiled code, which
+            # keeps the parse tree it was compiled from and looks up
+            # the names in the environment the closure was made in
+            code = value.code
+            return Closure(Scope({}, code.environment(value.env)), code.ast)
+        return self.const(value)
+
+    def pop(self, stack, t=None):
+        if not stack:
+            raise CompileError
+        value = stack.pop()
+        if t is not None and (not isinstance(value, Value) or value.type != t):
+            raise CompileError
+        return value
+
+    def pop_closure(self, stack):
+        value = self.pop(stack)
+        if not isinstance(value, Closure):
+            raise CompileError
+        return value
+
+    def compile_body(self, ast, scope, stack, lines, indent):
+        self.depth += 1
+        if self.depth > max_depth:
+            raise CompileError
+        for t, v in ast:
+            if t in ['Integer', 'Real', 'Boolean']:
+                stack.append(self.literal(t, v))
+            elif t == 'Point':
+                # folded by partialeval
+                stack.append(self.const(v))
+            elif t == 'Binder':
+                scope = scope.bind(v, self.pop(stack))
+            elif t == 'Identifier':
+                stack.append(self.lookup(scope, v))
+            elif t == 'Function':
+                stack.append(Closure(scope, v))
+            elif t == 'Operator' and v == 'apply':
+                c = self.pop_closure(stack)
+                self.compile_body(c.ast, c.scope, stack, lines, indent)
+            elif t == 'Operator' and v == 'if':
+                self.compile_if(stack, lines, indent)
+            elif t == 'Operator' and v in ['get', 'length']:
+                self.compile_array(v, stack, lines, indent)
+            elif t == 'Operator' and v in operators:
+                argtypes, restype, expr = operators[v]
+                args = [self.use(self.pop(stack, argtype))
+                        for argtype in reversed(argtypes)]
+                args.reverse()
+                var = self.var()
+                self.emit(lines, indent, "%s = %s" % (var, expr % tuple(args)))
+                stack.append(Value(restype, var))
+            else:
+                raise CompileError
+        self.depth -= 1
+        return stack
+
+    def compile_array(self, op, stack, lines, indent):
+        if op == 'get':
+            i = self.pop(stack, 'Integer')
+        a = self.pop(stack)
+        if not isinstance(a, Value) or a.type[0] != 'Array':
+            raise CompileError
+        var = self.var()
+        if op == 'get':
+            if a.type[1] is None:
+                raise CompileError
+            self.emit(lines, indent, "%s = get(%s, %s)" % (var, self.use(a), self.use(i)))
+            stack.append(Value(a.type[1], var))
+        else:
+            self.emit(lines, indent, "%s = len(%s)" % (var, self.use(a)))
+            stack.append(Value('Integer', var))
+
+    def compile_if(self, stack, lines, indent):
+        c2 = self.pop_closure(stack)
+        c1 = self.pop_closure(stack)
+        pred = self.pop(stack, 'Boolean')
+        if pred.expr in ["(True)", "(False)"]:
+            c = pred.expr == "(True)" and c1 or c2
+            self.compile_body(c.ast, c.scope, stack, lines, indent)
+            return
+        lines1 = []
+        stack1 = self.compile_body(c1.ast, c1.scope, list(stack), lines1, indent + 1)
+        lines2 = []
+        stack2 = self.compile_body(c2.ast, c2.scope, list(stack), lines2, indent + 1)
+        if len(stack1) != len(stack2):
+            raise CompileError
+        # values that differ between the branches are assigned to
+        # a common variable at the end of both
+        merged = []
+        for v1, v2 in zip(stack1, stack2):
+            if v1 is v2:
+                merged.append(v1)
+            elif isinstance(v1, Value) and isinstance(v2, Value) and \
+                 v1.type == v2.type:
+                var = self.var()
+                self.emit(lines1, indent + 1, "%s = %s" % (var, self.use(v1)))
+                self.emit(lines2, indent + 1, "%s = %s" % (var, self.use(v2)))
+                merged.append(Value(v1.type, var))
+            else:
+                raise CompileError
+        self.emit(lines, indent, "if %s:" % self.use(pred))
+        lines.extend(lines1 or ["    " * (indent + 1) + "pass"])
+        self.emit(lines, indent, "else:")
+        lines.extend(lines2 or ["    " * (indent + 1) + "pass"])
+        stack[:] = merged
+
+    def compile_surface(self, env, ast):
+        stack = [Value('Integer', 'face'), Value('Real', 'u'), Value('Real', 'v')]
+        lines = []
+        self.compile_body(ast, Scope({}, env), stack, lines, 1)
+        n = self.pop(stack, 'Real')
+        ks = self.pop(stack, 'Real')
+        kd = self.pop(stack, 'Real')
+        sc = self.pop(stack, 'Point')
+        self.emit(lines, 1, "return %s, %s, %s, %s" % (self.use(sc), self.use(kd),
+                                                       self.use(ks), self.use(n)))
+        return "def surface(face, u, v):\n" + "\n".join(lines) + "\n"
+
+# the code objects of the compiled sources
+code_cache = {}
+
+def face_table(f):
+    # the results of a surface that only depends on the face, or
+    # nothing at all, are computed once per face
+    table = {}
+    def surface(face, u, v):
+        try:
+            return table[face]
+        except KeyError:
+            res = table[face] = f(face, u, v)
+            return res
+    surface.uses_uv = False
+    return surface
+
+def compile_surface(env, ast):
+    # Returns a Python function of (face, u, v) that computes the
+    # same (color, kd, ks, n) as the surface closure with environment
+    # env and body ast, or raises CompileError. If its uses_uv is
+    # False it doesn't read u and v, so they need not be computed.
+    compiler = Compiler()
+    source = compiler.compile_surface(env, ast)
+    code = code_cache.get(source)
+    if code is None:
+        ns = {}
+        exec compile(source, "<surface>", "exec") in ns
+        code = ns['surface'].func_code
+        code_cache[source] = code
+    namespace = dict(runtime)
+    namespace.update(compiler.consts)
+    f = types.FunctionType(code, namespace, 'surface')
+    if 'u' in compiler.uses or 'v' in compiler.uses:
+        f.uses_uv = True
+        return f
+    return face_table(f)
+
+if __name__=="__main__":
+    from tokenizer import tokenize
+    from parser import parse
+
+    def test(gml, env, args, res):
+        ast = parse(tokenize(gml))
+        try:
+            f = compile_surface(env, ast)
+        except CompileError:
+            f = None
+        if res is CompileError:
+            if f is not None:
+                print gml, "should not compile"
+        elif f is None:
+            print gml, "did not compile"
+        elif f(*args) != res:
+            print gml, "!=", res
+            print gml, "==", f(*args)
+
+    red = (1.0, 0.0, 0.0)
+    blue = (0.0, 0.0, 1.0)
+    env = {'red': red, 'blue': blue, 'n': 2.0}
+    test("/v /u /face red 1.0 0.0 n", env, (0, 0.5, 0.5), ((1.0, 0.0, 0.0), 1.0, 0.0, 2.0))
+    test("/v /u /face face 1 eqi { red } { blue } if 0.5 0.5 1.0",
+         env, (1, 0.0, 0.0), ((1.0, 0.0, 0.0), 0.5, 0.5, 1.0))
+    test("/v /u /face face 1 eqi { red } { blue } if 0.5 0.5 1.0",
+         env, (2, 0.0, 0.0), ((0.0, 0.0, 1.0), 0.5, 0.5, 1.0))
+    test("/v /u /face u v { /b /a a b mulf } apply /c c c c point c c 3.0",
+         env, (0, 2.0, 0.25), ((0.5, 0.5, 0.5), 0.5, 0.5, 3.0))
+    test("/v /u /face u 12.0 mulf floor 2 modi 1 eqi { red } { blue } if 0.0 0.0 1.0",
+         env, (0, 0.1, 0.0), ((1.0, 0.0, 0.0), 0.0, 0.0, 1.0))
+    test("/v /u /face { /self self self apply } /loop loop loop apply",
+         env, None, CompileError)
+    test("/v /u /face face 1 eqi { red } { 1.0 } if 0.0 0.0 1.0",
+         env, None, CompileError)
+    test("/v /u /face missing 0.0 0.0 1.0", env, None, CompileError)
+    env['faces'] = [red, blue]
+    test("/v /u /face faces face get faces length real 0.0 1.0",
+         env, (1, 0.0, 0.0), ((0.0, 0.0, 1.0), 2.0, 0.0, 1.0))
+    try:
+        compile_surface(env, parse(tokenize("/v /u /face faces face get 0.0 0.0 1.0")))(2, 0.0, 0.0)
+        print "faces 2 get != IndexError"
+    except IndexError:
+        pass
+    env['mixed'] = [red, 1.0]
+    test("/v /u /face mixed face get 0.0 0.0 1.0", env, None, CompileError)
+
+    def test_uses(gml, res):
+        f = compile_surface({}, parse(tokenize(gml)))
+        if f.uses_uv != res:
+            print gml, "uses_uv", f.uses_uv, "!=", res
+
+    test_uses("/v /u /face 1.0 1.0 1.0 point 1.0 0.0 1.0", False)
+    test_uses("/v /u /face face real 1.0 1.0 point 1.0 0.0 1.0", False)
+    test_uses("/v /u /face u 1.0 1.0 point 1.0 0.0 1.0", True)
+    test_uses("/v /u /face face 0 eqi { v } { 1.0 } if 1.0 1.0 point 1.0 0.0 1.0", True)
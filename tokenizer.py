@@ -61,6 +61,9 @@ operators.sort(lambda a, b: cmp(len(b), len(a)))
 class EvaluationError(Exception):
     pass
 
+class UnexpectedCharacter(EvaluationError):
+    pass
+
 def eval_boolean(s):
     if s == 'true':
         return True
@@ -69,42 +72,69 @@ def eval_boolean(s):
     else:
         raise EvaluationError
 
+# The tokens, in the order they are tried at every position: the first
+# one that matches is taken, even when a later one would match more
+# ("trueish" is true and ish)
 tokens = []
-tokens.append((re.compile(r"\s+"), "Whitespace", False, None))
-tokens.append((re.compile(r"%.*\n"), "Comment", False, None))
-tokens.append((re.compile(r"\{"), "BeginFunction", True, None))
-tokens.append((re.compile(r"\}"), "EndFunction", True, None))
-tokens.append((re.compile(r"\["), "BeginArray", True, None))
-tokens.append((re.compile(r"\]"), "EndArray", True, None))
-tokens.append((re.compile(r"true|false"), "Boolean", True, eval_boolean))
-tokens.append((re.compile(r"[a-zA-Z][a-zA-Z0-9-_]*"), "Identifier", True, str))
-tokens.append((re.compile(r"/[a-zA-Z][a-zA-Z0-9-_]*"), "Binder", True, lambda s: s[1:]))
-tokens.append((re.compile(r"-{0,1}\d+(?:(?:\.\d+(?:[eE]-{0,1}\d+){0,1})|(?:[eE]-{0,1}\d+))"), "Real", True, lambda r: float(r)))
-tokens.append((re.compile(r"-{0,1}\d+"), "Integer", True, lambda i: int(i)))
-tokens.append((re.compile(r"\".*\""), "String", True, lambda s: s[1:-1]))
-
-def do_tokenize(text, tokenlist):
-    while text:
-        for regexp, tokenname, emit, evaluator in tokens:
-            m = regexp.match(text)
-            if m:
-                text = text[m.end():]
-                if emit:
-                    if tokenname == "Identifier":
-                        if m.group() in operators:
-                            tokenname = "Operator"
-                    elif tokenname == "Binder":
-                        if m.group() in operators:
-                            raise EvaluationError, m.group() + " is a reserved word, cannot bind"
-                    tokenlist.append((tokenname, evaluator and evaluator(m.group())))
-                break
-        else:
+tokens.append((r"\s+", "Whitespace", False, None))
+tokens.append((r"%.*\n", "Comment", False, None))
+tokens.append((r"\{", "BeginFunction", True, None))
+tokens.append((r"\}", "EndFunction", True, None))
+tokens.append((r"\[", "BeginArray", True, None))
+tokens.append((r"\]", "EndArray", True, None))
+tokens.append((r"true|false", "Boolean", True, eval_boolean))
+tokens.append((r"[a-zA-Z][a-zA-Z0-9-_]*", "Identifier", True, str))
+tokens.append((r"/[a-zA-Z][a-zA-Z0-9-_]*", "Binder", True, lambda s: s[1:]))
+tokens.append((r"-{0,1}\d+(?:(?:\.\d+(?:[eE]-{0,1}\d+){0,1})|(?:[eE]-{0,1}\d+))", "Real", True, lambda r: float(r)))
+tokens.append((r"-{0,1}\d+", "Integer", True, lambda i: int(i)))
+tokens.append((r"\".*\"", "String", True, lambda s: s[1:-1]))
+
+# All the tokens in one pattern, with a group for each named after it,
+# which alternation tries in the same order
+pattern = re.compile("|".join(["(?P<%s>%s)" % (tokenname, regexp)
+                               for regexp, tokenname, emit, evaluator in tokens]))
+actions = dict([(tokenname, (emit, evaluator))
+                for regexp, tokenname, emit, evaluator in tokens])
+
+reserved = set(operators)
+
+def generate_tokens(text, line=1, strict=False):
+    # Yields the tokens of text as (name, value, (line, column)), with
+    # text starting on line and columns counted from 1, scanning it
+    # once. Stops at the first character no token starts with, or if
+    # strict raises UnexpectedCharacter there.
+    match = pattern.match
+    pos = 0
+    n = len(text)
+    line_start = 0
+    while pos < n:
+        m = match(text, pos)
+        if m is None:
+            if strict:
+                raise UnexpectedCharacter, "unexpected %r at line %d, column %d" % \
+                      (text[pos], line, pos - line_start + 1)
             break
+        tokenname = m.lastgroup
+        end = m.end()
+        emit, evaluator = actions[tokenname]
+        if emit:
+            s = m.group()
+            # binders of operator names, like /sphere, are accepted, as
+            # they always were, and the name still means the operator
+            if tokenname == "Identifier" and s in reserved:
+                tokenname = "Operator"
+            yield tokenname, evaluator and evaluator(s), (line, pos - line_start + 1)
+        else:
+            # only whitespace and comments span lines
+            newlines = text.count("\n", pos, end)
+            if newlines:
+                line += newlines
+                line_start = text.rindex("\n", pos, end) + 1
+        pos = end
 
 def tokenize(text):
-    ret = []
-    do_tokenize(text, ret)
-    return ret
+    return [(tokenname, value)
+            for tokenname, value, position in generate_tokens(text)]
 
 
 def test(gml, res):
@@ -169,3 +199,24 @@ if __name__=="__main__":
                        ('EndFunction', None)])
 
     
+
+    test("trueish", [('Boolean', True), ('Identifier', 'ish')])
+    test("1 2 ? 3", [('Integer', 1), ('Integer', 2)])
+
+    t = list(generate_tokens("1 % apa\n  { x\r\n/y }"))
+    if [p for n, v, p in t] != [(1, 1), (2, 3), (2, 5), (3, 1), (3, 4)]:
+        print "positions ==", t
+
+    t = list(generate_tokens("1\n 2", 5))
+    if [p for n, v, p in t] != [(5, 1), (6, 2)]:
+        print "positions ==", t
+
+    try:
+        list(generate_tokens("1 ?", 1, True))
+        print "? != UnexpectedCharacter"
+    except UnexpectedCharacter:
+        pass
+
+    t = tokenize("1 /addi")
+    if t != [('Integer', 1), ('Binder', 'addi')]:
+        print "1 /addi ==", t
@@ -1,4 +1,9 @@
 import math
+try:
+    import numpy
+except ImportError:
+    # only needed for transforming ray packets
+    numpy = None
 from vecmat import mcmp, mmmul, mvmul, mvmul3, mvmulx, mvmuly, mvmulz, transpose, identity
 
 class Transform(object):
@@ -52,6 +57,29 @@ class Transform(object):
         x, y, z = v
         return mvmulz(self.inv_m, (x, y, z, 1.0))
     
+    def inv_transform_points(self, p):
+        m = numpy.array(self.inv_m)
+        return numpy.dot(p, m[:3, :3].T) + m[:3, 3]
+
+    def inv_transform_vectors(self, v):
+        m = numpy.array(self.inv_m)
+        return numpy.dot(v, m[:3, :3].T)
+
+    def copy(self):
+        # the matrices are never changed in place, so they can be shared
+        res = Transform()
+        res.m = self.m
+        res.inv_m = self.inv_m
+        return res
+
+    def combine(self, t):
+        # the transform that applies t and then this one, equal to
+        # applying the steps of both in turn up to rounding
+        res = Transform()
+        res.m = mmmul(self.m, t.m)
+        res.inv_m = mmmul(t.inv_m, self.inv_m)
+        return res
+
     def scale(self, sx, sy, sz):
         sc = ((sx, 0.0, 0.0, 0.0),
               (0.0, sy, 0.0, 0.0),
@@ -144,3 +172,8 @@ if __name__=="__main__":
     t._check()
     t.rotatez(63)
     t._check()
+    t2 = Transform()
+    t2.rotatex(-42)
+    t2.translate(3, 2, 1)
+    t.combine(t2)._check()
+    t2.combine(t)._check()
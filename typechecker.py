@@ -0,0 +1,396 @@
+# Infers the types of GML values before the program runs. The program
+# is evaluated symbolically, with types in place of values: a type is
+# one of 'Integer', 'Real', 'Boolean', 'String', 'Point', 'Object',
+# 'Light', ('Array', element type), a Closure known statically, or
+# None when it is unknown. An operator applied to a known type it
+# doesn't take is a type error, reported before evaluation starts.
+#
+# Every closure body is checked once on its own, starting from an
+# unknown stack, so whatever it proves there holds for every call of
+# it. The applies and ifs it proves to get closures and booleans, and
+# the operators it proves to get operands of their types, are
+# returned, and the evaluator doesn't check them at runtime. The
+# folder can put the same body in several places, and inline bodies
+# are checked with the stack of the place they are in, so a site is
+# only proven if every check of it in its own context proves it.
+# Applying a known closure checks its body again with the actual
+# stack, to find the effect of the call and the type errors of that
+# call, but nothing proven there is kept. The branches of an if don't report
+# the type errors that come from the stack they start with, because it
+# may only be right for them when the branch is taken (features.gml
+# calls a closure that breaks on purpose in branches that are never
+# taken), and what they prove is dropped if they have any. Branches
+# are checked on their own for their other errors. Recursion, and
+# calls that are too deep, make the stack unknown.
+
+class TypeCheckError(Exception):
+    pass
+
+# operator: (operand types, result type or None)
+operators = {
+    'addi': (('Integer', 'Integer'), 'Integer'),
+    'addf': (('Real', 'Real'), 'Real'),
+    'subi': (('Integer', 'Integer'), 'Integer'),
+    'subf': (('Real', 'Real'), 'Real'),
+    'muli': (('Integer', 'Integer'), 'Integer'),
+    'mulf': (('Real', 'Real'), 'Real'),
+    'divi': (('Integer', 'Integer'), 'Integer'),
+    'divf': (('Real', 'Real'), 'Real'),
+    'modi': (('Integer', 'Integer'), 'Integer'),
+    'negi': (('Integer',), 'Integer'),
+    'negf': (('Real',), 'Real'),
+    'eqi': (('Integer', 'Integer'), 'Boolean'),
+    'eqf': (('Real', 'Real'), 'Boolean'),
+    'lessi': (('Integer', 'Integer'), 'Boolean'),
+    'lessf': (('Real', 'Real'), 'Boolean'),
+    'acos': (('Real',), 'Real'),
+    'asin': (('Real',), 'Real'),
+    'clampf': (('Real',), 'Real'),
+    'cos': (('Real',), 'Real'),
+    'sin': (('Real',), 'Real'),
+    'sqrt': (('Real',), 'Real'),
+    'floor': (('Real',), 'Integer'),
+    'frac': (('Real',), 'Real'),
+    'real': (('Integer',), 'Real'),
+    'point': (('Real', 'Real', 'Real'), 'Point'),
+    'getx': (('Point',), 'Real'),
+    'gety': (('Point',), 'Real'),
+    'getz': (('Point',), 'Real'),
+    'sphere': (('Closure',), 'Object'),
+    'cube': (('Closure',), 'Object'),
+    'cylinder': (('Closure',), 'Object'),
+    'cone': (('Closure',), 'Object'),
+    'plane': (('Closure',), 'Object'),
+    'union': (('Object', 'Object'), 'Object'),
+    'intersect': (('Object', 'Object'), 'Object'),
+    'difference': (('Object', 'Object'), 'Object'),
+    'translate': (('Object', 'Real', 'Real', 'Real'), 'Object'),
+    'scale': (('Object', 'Real', 'Real', 'Real'), 'Object'),
+    'uscale': (('Object', 'Real'), 'Object'),
+    'rotatex': (('Object', 'Real'), 'Object'),
+    'rotatey': (('Object', 'Real'), 'Object'),
+    'rotatez': (('Object', 'Real'), 'Object'),
+    'light': (('Point', 'Point'), 'Light'),
+    'pointlight': (('Point', 'Point'), 'Light'),
+    'spotlight': (('Point', 'Point', 'Point', 'Real', 'Real'), 'Light'),
+    'render': (('Point', ('Array', 'Light'), 'Object', 'Integer', 'Real',
+                'Integer', 'Integer', 'String'), None),
+}
+
+surfaces = ['sphere', 'cube', 'cylinder', 'cone', 'plane']
+
+# limits for checking the bodies of the closures that are applied
+max_depth = 32
+max_steps = 20000
+
+class Closure(object):
+    # a closure known statically
+    def __init__(self, scope, ast):
+        self.scope = scope
+        self.ast = ast
+
+class Stack(object):
+    # the types on the stack, with unknown values below them if open
+    def __init__(self, items, open):
+        self.items = items
+        self.open = open
+
+    def copy(self):
+        return Stack(list(self.items), self.open)
+
+    def push(self, t):
+        self.items.append(t)
+
+    def pop(self):
+        # popping an empty stack is left to fail at runtime, programs
+        # like features.gml do it on purpose in branches never taken
+        if self.items:
+            return self.items.pop()
+        return None
+
+    def forget(self):
+        self.items = []
+        self.open = True
+
+    def assign(self, s):
+        self.items = s.items
+        self.open = s.open
+
+def same(t1, t2):
+    if isinstance(t1, Closure) and isinstance(t2, Closure):
+        return t1.ast is t2.ast and t1.scope is t2.scope
+    return t1 == t2
+
+def merge(s1, s2):
+    if len(s1.items) != len(s2.items) or s1.open != s2.open:
+        return Stack([], True)
+    items = []
+    for t1, t2 in zip(s1.items, s2.items):
+        if same(t1, t2):
+            items.append(t1)
+        else:
+            items.append(None)
+    return Stack(items, s1.open)
+
+def name(t):
+    if isinstance(t, Closure):
+        return 'Closure'
+    if isinstance(t, tuple):
+        return 'Array of %s' % name(t[1])
+    if t is None:
+        return 'anything'
+    return t
+
+def matches(want, got):
+    if got is None or want is None:
+        return True
+    if want == 'Closure':
+        return isinstance(got, Closure)
+    if isinstance(want, tuple):
+        return isinstance(got, tuple) and matches(want[1], got[1])
+    return want == got
+
+class Checker(object):
+    def __init__(self):
+        self.proven = set()
+        # the sites a check in their own context didn't prove
+        self.unproven = set()
+        # closure bodies to check on their own, with their scopes
+        self.pending = []
+        self.active = []
+        self.steps = 0
+        # the number of ifs the current point is in a branch of, how
+        # many of those don't report errors, and whether an error
+        # wasn't reported
+        self.branches = 0
+        self.quiet = 0
+        self.suppressed = False
+
+    def expect(self, op, want, got):
+        if not matches(want, got):
+            if self.quiet:
+                self.suppressed = True
+            else:
+                raise TypeCheckError("%s expects %s, got %s" % (op, name(want), name(got)))
+
+    def check_program(self, ast, scope, stack):
+        self.pending.append((scope, ast, Stack(list(stack), False)))
+        while self.pending:
+            scope, ast, stack = self.pending.pop()
+            self.steps = 0
+            self.check_body(ast, scope, stack, True)
+        return self.proven - self.unproven
+
+    def prove(self, ast, i, proven):
+        # what a check of the operator at index i of ast found
+        if proven:
+            self.proven.add((id(ast), i))
+        else:
+            self.unproven.add((id(ast), i))
+
+    def call(self, c, stack):
+        # the effect of applying c to the stack
+        if id(c.ast) in self.active or len(self.active) >= max_depth or \
+           self.steps > max_steps:
+            stack.forget()
+            return
+        quiet = self.branches > 0
+        self.quiet += quiet
+        self.active.append(id(c.ast))
+        self.check_body(c.ast, c.scope, stack, False)
+        self.active.pop()
+        self.quiet -= quiet
+
+    def check_branch(self, ast, scope, stack, home):
+        # the stack after the inline branch ast of an if
+        if home:
+            self.check_body(ast, scope, Stack([], True), False)
+        proven = set(self.proven)
+        suppressed = self.suppressed
+        self.suppressed = False
+        self.quiet += 1
+        s = stack.copy()
+        self.check_body(ast, scope, s, home)
+        self.quiet -= 1
+        if self.suppressed:
+            self.proven = proven
+        self.suppressed = suppressed or self.suppressed
+        return s
+
+    def check_surface(self, op, c):
+        # a surface takes the face and the texture coordinates and
+        # leaves the color and the reflection coefficients
+        stack = Stack(['Integer', 'Real', 'Real'], False)
+        self.call(c, stack)
+        for want in ['Real', 'Real', 'Real', 'Point']:
+            self.expect(op + " surface", want, stack.pop())
+
+    def check_body(self, ast, scope, stack, home):
+        # home is whether ast is only run in the context it is checked
+        # in, so that what is proven can be kept
+        i = 0
+        n = len(ast)
+        while i < n:
+            t, v = ast[i]
+            i += 1
+            self.steps += 1
+            if t in ['Integer', 'Real', 'Boolean', 'String', 'Point']:
+                stack.push(t)
+            elif t == 'Binder':
+                scope = dict(scope)
+                scope[v] = stack.pop()
+            elif t == 'Identifier':
+                if v not in scope:
+                    raise TypeCheckError("unbound identifier %s" % v)
+                stack.push(scope[v])
+            elif t == 'Function':
+                # the evaluator inlines the same patterns
+                if ast[i:i + 1] == [('Operator', 'apply')]:
+                    self.check_body(v, scope, stack, home)
+                    i += 1
+                elif i + 1 < n and ast[i][0] == 'Function' and \
+                     ast[i + 1] == ('Operator', 'if'):
+                    pred = stack.pop()
+                    self.expect('if', 'Boolean', pred)
+                    if home:
+                        self.prove(ast, i + 1, pred == 'Boolean')
+                    self.branches += 1
+                    s1 = self.check_branch(v, scope, stack, home)
+                    s2 = self.check_branch(ast[i][1], scope, stack, home)
+                    self.branches -= 1
+                    stack.assign(merge(s1, s2))
+                    i += 2
+                else:
+                    if home:
+                        self.pending.append((scope, v, Stack([], True)))
+                    stack.push(Closure(scope, v))
+            elif t == 'Array':
+                s = Stack([], False)
+                self.check_body(v, scope, s, home)
+                elem = None
+                if not s.open and s.items and \
+                   all(same(e, s.items[0]) for e in s.items):
+                    elem = s.items[0]
+                stack.push(('Array', elem))
+            elif t == 'Operator' and v == 'apply':
+                c = stack.pop()
+                self.expect('apply', 'Closure', c)
+                if home:
+                    self.prove(ast, i - 1, c is not None)
+                if c is None:
+                    stack.forget()
+                else:
+                    self.call(c, stack)
+            elif t == 'Operator' and v == 'if':
+                c2 = stack.pop()
+                c1 = stack.pop()
+                pred = stack.pop()
+                self.expect('if', 'Closure', c2)
+                self.expect('if', 'Closure', c1)
+                self.expect('if', 'Boolean', pred)
+                if home:
+                    self.prove(ast, i - 1, c1 is not None and c2 is not None and
+                               pred == 'Boolean')
+                if c1 is None or c2 is None:
+                    stack.forget()
+                else:
+                    self.branches += 1
+                    s1 = stack.copy()
+                    self.call(c1, s1)
+                    s2 = stack.copy()
+                    self.call(c2, s2)
+                    self.branches -= 1
+                    stack.assign(merge(s1, s2))
+            elif t == 'Operator' and v == 'get':
+                index = stack.pop()
+                a = stack.pop()
+                self.expect('get', 'Integer', index)
+                self.expect('get', ('Array', None), a)
+                stack.push(a and a[1])
+            elif t == 'Operator' and v == 'length':
+                self.expect('length', ('Array', None), stack.pop())
+                stack.push('Integer')
+            elif t == 'Operator' and v in operators:
+                argtypes, restype = operators[v]
+                args = [stack.pop() for argtype in argtypes]
+                args.reverse()
+                for want, got in zip(argtypes, args):
+                    self.expect(v, want, got)
+                if home:
+                    self.prove(ast, i - 1, args == list(argtypes))
+                if v in surfaces and args[0] is not None:
+                    self.check_surface(v, args[0])
+                if restype is not None:
+                    stack.push(restype)
+            else:
+                stack.forget()
+
+def check(ast, scope={}, stack=()):
+    # Raises TypeCheckError if the program is ill-typed, otherwise
+    # returns the apply and if operators of ast that are sure to get
+    # closures, and booleans for if, and the other operators that are
+    # sure to get operands of their types, as the id of the list they
+    # are in and their index in it. scope and stack are the types of the
+    # names bound, and of the values left, by code run before ast.
+    return Checker().check_program(ast, scope, stack)
+
+if __name__=="__main__":
+    from tokenizer import tokenize
+    from parser import parse
+
+    def test(gml, res):
+        ast = parse(tokenize(gml))
+        try:
+            proven = check(ast)
+        except TypeCheckError:
+            proven = TypeCheckError
+        if res is TypeCheckError or proven is TypeCheckError:
+            if proven is not res:
+                print gml, "!=", res
+        elif len(proven) != res:
+            print gml, "proves", len(proven), "!=", res
+
+    test("1 2 addi", 1)
+    test("{ 1.0 addf } /bad 1 true { } bad if", 1)
+    test("{ 1.0 addf } /bad 1 bad apply", TypeCheckError)
+    test("{ 1.0 1 addi } /bad", TypeCheckError)
+    test("1 true { 1.0 addf } { } if", 1)
+    test("1 true { 1.0 1 addf } { } if", TypeCheckError)
+    test("1 2.0 addi", TypeCheckError)
+    test("1 /x x x addf", TypeCheckError)
+    test("{ /x x x mulf } /sq 2 sq apply", TypeCheckError)
+    test("{ /x x x mulf } /sq 2.0 sq apply", 1)
+    test("{ /x x x mulf } /sq 2.0 sq apply 3 sq apply", TypeCheckError)
+    test("1 2 lessi { 1 } { 2 } if 3 addi", 3)
+    test("1 { 1 } { 2 } if", TypeCheckError)
+    test("true { 1 } { 2.0 } if 3 addi", 1)
+    test("{ /c /b /a a b c if } /choose true { 1 } { 2 } choose apply", 1)
+    test("{ /f 1 f apply } /call", 0)
+    test("missing", TypeCheckError)
+    test("addi", 0)
+    test("[ 1 2 3 ] 1 get 2 addi", 1)
+    test("[ 1 2 3 ] 1 get 2.0 addf", TypeCheckError)
+    test("[ 1 2.0 ] 1 get 2.0 addf", 0)
+    test("{ /self /n n 0 eqi { 0 } { n 1 subi self self apply } if } /loop 10 loop loop apply", 2)
+    test("{ /v /u /face 1.0 1.0 1.0 point 1.0 0.0 1.0 } sphere", 1)
+    test("{ /v /u /face u 1.0 1.0 point 1.0 0.0 1 } sphere", TypeCheckError)
+    test("{ /v /u /face face 1.0 1.0 point 1.0 0.0 1.0 } sphere", TypeCheckError)
+
+    # names and values from code run before
+    test_ast = parse(tokenize("x 1 addi addi"))
+    if len(check(test_ast, {'x': 'Integer'}, ['Integer'])) != 2:
+        print "x 1 addi addi with x an Integer fails"
+    try:
+        check(test_ast, {'x': 'Real'}, ['Integer'])
+        print "x 1 addi addi with x a Real passes"
+    except TypeCheckError:
+        pass
+
+    # a body the folder puts in two places is only proven where both
+    # places prove it
+    from partialeval import fold
+    test_ast = fold(parse(tokenize("{ /c c { 1 } { 2 } if } /f [ 1 ] 0 get 2 lessi f apply "
+                                   "[ 1 true ] 0 get f apply")))
+    body = test_ast[-2][1]
+    if test_ast[7][1] is not body or (id(body), 4) in check(test_ast):
+        print "the if of f is proven"